@@ -0,0 +1,4 @@
+from src.distance_service import main
+
+if __name__ == '__main__':
+    main()
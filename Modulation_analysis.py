@@ -0,0 +1,4 @@
+from src.modulation_analysis import main
+
+if __name__ == '__main__':
+    main()
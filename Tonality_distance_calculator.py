@@ -1,14 +1,16 @@
+import json
 import os
-import networkx as nx
+import pkgutil
 import numpy as np
 from pathlib import Path
 import sys
 
-from dash import Dash, dcc, html, callback, Output, Input, State, ctx, no_update
-from src.tonality_distance import get_tonality_distance
+from dash import Dash, dcc, html, callback, Output, Input, State, ctx, no_update, Patch
+from src.distance_cache import cached_shortest_path_tree
+from src.distance_service import distance_api
+from src import instrumentation
+from src.tonality_distance import MODULATIONS, MODULATION_WEIGHT_INDEX
 from src.music_theory import *
-import plotly.express as px
-import plotly.graph_objects as go
 
 edge_color_dict = {'Neighbor':'blue','Relative':'green','Parallel':'red','Dominant':'purple','Enharmonic':'orange'}
 
@@ -19,58 +21,74 @@ text_color = []
 annotations = []
 custom_data = []
 
-for diatonic in range(7):
-    for chromatic in range(12):
-        pitch = Pitch.from_dia_chro(diatonic,chromatic)
-
-        x.append(chromatic)
-        y.append(diatonic)
-
-        x.append(chromatic+0.3)
-        y.append(diatonic)
-
-        text_color.append('blue')
-        text_color.append('red')
-
-        if len(pitch.accidental)<=1 :
-            text.append(f'{pitch.name}')
-            text.append(f'{pitch.name.lower()}')
-        else:
-            text.append(f'\u25EF')
-            text.append(f'\u25EF')
-
-        annotations.append(f'{pitch.name}')
-        annotations.append(f'{pitch.name.lower()}')
-        custom_data.append((diatonic,chromatic,'M'))
-        custom_data.append((diatonic,chromatic,'m'))
-
-text_trace = go.Scatter(x = x, y = y,
-                    mode = 'text',
-                    text = text,
-                    textfont= dict(size = 16, color = text_color),
+# One pass over the 84 pitches builds the coordinates, labels and hover texts of the 168 keys
+for pitch in Pitch._by_dia_chro:
+    diatonic, chromatic = pitch.diatonic, pitch.chromatic
+    x += [chromatic, chromatic+0.3]
+    y += [diatonic, diatonic]
+    text_color += ['blue', 'red']
+    if len(pitch.accidental)<=1 :
+        text += [pitch.name, pitch.name.lower()]
+    else:
+        text += ['\u25EF', '\u25EF']
+    annotations += [pitch.name, pitch.name.lower()]
+    custom_data += [(diatonic,chromatic,'M'), (diatonic,chromatic,'m')]
+
+# The figure is a plain dict rather than a go.Figure: building and validating plotly graph objects was most
+# of the time spent importing this module
+text_font = dict(color = text_color, size = 16)
+text_trace = dict(type = 'scatter', x = x, y = y,
+                  mode = 'text',
+                  text = text,
+                  textfont = text_font,
+                  hoverinfo = 'skip',
+                  showlegend=False)
+invis_node = dict(type = 'scatter', x = x, y = y,
+                  mode = 'markers',
+                  text = annotations,
+                  hoverinfo = 'text',
+                  marker= dict(color = text_color),
+                  opacity=0,
+                  customdata=custom_data,
+                  showlegend=False)
+
+# Static parts of the figure, computed once: callbacks only send Patch updates of the fields that change
+key_positions = {name: i for i, name in enumerate(annotations)}
+base_font_weights = ['normal'] * len(annotations)
+base_text_colors = ['rgba(0,0,255,0.5)', 'rgba(255,0,0,0.5)'] * (len(annotations) // 2)
+selected_text_colors = ['rgba(0,0,255,1)', 'rgba(255,0,0,1)'] * (len(annotations) // 2)
+
+# The shortest path is drawn with one trace per modulation, edges being separated by None
+path_modulations = list(dict.fromkeys(modulation for *_, modulation in MODULATIONS))
+path_trace_offset = 2
+
+path_traces = [dict(type = 'scatter',
+                    x = [],
+                    y = [],
+                    mode = 'lines+markers',
+                    line = dict(width=2, color = edge_color_dict[modulation_descr.split(' ')[0]],),
+                    marker= dict(symbol= "arrow-bar-up", angleref="previous"),
                     hoverinfo = 'skip',
+                    name = modulation_descr,
                     showlegend=False)
-invis_node = go.Scatter(x = x, y = y,
-                        mode = 'markers',
-                        text = annotations,
-                        hoverinfo = 'text',
-                        marker= dict(color = text_color),
-                        opacity=0,
-                        customdata=custom_data,
-                        showlegend=False)
-
-fig = go.Figure()
-fig.add_trace(text_trace)
-fig.add_trace(invis_node)
-fig.update_layout(showlegend=True)
-
-keys = []
-for dia in range(7):
-    for chro in range(12):
-        for mode in ['m','M']:
-            pitch = Pitch.from_dia_chro(dia,chro)
-            keys.append(f'{pitch.name if mode == "M" else pitch.name.lower()}')
-keys = sorted(keys, key = lambda x: (len(x),x))
+               for modulation_descr in path_modulations]
+# go.Figure would apply plotly's default template when serializing the figure, it is read from its JSON file
+plotly_template = json.loads(pkgutil.get_data('plotly', 'package_data/templates/plotly.json'))
+fig = dict(data = [text_trace, invis_node] + path_traces, layout = dict(showlegend=True, template=plotly_template))
+
+def patch_path(patched_figure, shortest_path=(), modulations=()):
+    segments = {modulation_descr: ([], []) for modulation_descr in path_modulations}
+    for u, v, modulation_descr in zip(shortest_path, shortest_path[1:], modulations):
+        segment_x, segment_y = segments[modulation_descr]
+        segment_x += [u[1]+(0.3 if u[2]=='m' else 0), v[1]+(0.3 if v[2]=='m' else 0), None]
+        segment_y += [u[0], v[0], None]
+    for i, modulation_descr in enumerate(path_modulations):
+        segment_x, segment_y = segments[modulation_descr]
+        patched_figure['data'][path_trace_offset+i]['x'] = segment_x
+        patched_figure['data'][path_trace_offset+i]['y'] = segment_y
+        patched_figure['data'][path_trace_offset+i]['showlegend'] = len(segment_x) > 0
+
+keys = sorted(annotations, key = lambda x: (len(x),x))
 
 default_neighbor_weight = 1
 default_relative_weight = 0.7
@@ -78,8 +96,41 @@ default_parallel_weight = 1.3
 default_enharmonic_weight = 0.01
 default_dominant_weight = 1.2
 
+paths_per_page = 20
+
+def hover_annotations(shortest_path_tree, start_name, start_key):
+    """
+    Returns the hover text of every key: its name, its distance and a shortest path from the start key.
+    """
+    tonality_distance = shortest_path_tree.tonality_distance
+    start_pitch = Pitch.from_dia_chro(start_key[0], start_key[1])
+    start_mode = start_key[2]
+    new_annotations = []
+    for diatonic in range(7):
+        for chromatic in range(12):
+            pitch = Pitch.from_dia_chro(diatonic,chromatic)
+            interval = Interval(start_pitch, pitch)
+            for mode in ['M','m']:
+                shortest_path = shortest_path_tree.path(start_key,(diatonic,chromatic,mode))
+                distance = tonality_distance[interval.diatonic,interval.chromatic,2*int(start_mode == 'm')+int(mode=='m')]
+                pitch_name = pitch.name if mode == 'M' else pitch.name.lower()
+                new_annotations.append(f'{pitch_name}<br>'\
+                                       f'Distance from {start_name}: {distance}<br>'\
+                                       f'Shortest path: {shortest_path}')
+    return new_annotations
+
+def shortest_path_options(path_count, page):
+    return [{'label':f'Shortest path n°{i+1}', 'value':i} for i in range(page*paths_per_page, min(path_count, (page+1)*paths_per_page))]
+
 app = Dash(__name__)
 app.title = 'Tonality distance calculator'
+# The JSON API of src/distance_service.py is served under /api next to the UI
+app.server.register_blueprint(distance_api)
+# Opt-in timings on /metrics (TONALITY_METRICS=1), nothing is wrapped otherwise
+if instrumentation.enabled_by_environment():
+    instrumentation.enable()
+    instrumentation.instrument(sys.modules[__name__], 'hover_annotations', 'path_loop')
+    instrumentation.install(app.server, int(os.environ.get('TONALITY_PROFILE_SLOWEST', 0)), app)
 app.layout = [
     html.H1('Tonality distance calculator'),
     html.Div([
@@ -125,6 +176,9 @@ app.layout = [
         dcc.Graph(id='keys_graph', figure=fig),
         html.Div(id='output'),
         dcc.RadioItems(id='shortest_path_selector',options=[]),
+        html.Button('Previous paths', id='previous_paths_button', n_clicks=0),
+        html.Button('Next paths', id='next_paths_button', n_clicks=0),
+        dcc.Store(id='shortest_path_page', data={'page':0, 'count':0}),
         html.Div(id='shortest_path_descr'),
     ]),
 
@@ -180,6 +234,7 @@ def select_key(clickData, key_selected):
     Output('shortest_path_descr', 'children'),
     Output('shortest_path_selector', 'options'),
     Output('shortest_path_selector', 'value'),
+    Output('shortest_path_page', 'data'),
     Input('key_selected', 'value'),
     Input('neighbor_weight', 'value'),
     Input('relative_weight', 'value'),
@@ -202,79 +257,80 @@ def update_keys_graph(key_selected,
     enharmonic_weight = enharmonic_weight if enharmonic_present else np.inf
     dominant_weight = dominant_weight if dominant_present else np.inf
     output_text = ''
-    fig = go.Figure()
-    fig.add_trace(text_trace)
-    fig.add_trace(invis_node)
-    fig.update_layout(showlegend=True)
+    patched_figure = Patch()
+    patch_path(patched_figure)
     options = []
     value = -1
+    path_count = 0
     if len(key_selected) >= 1:
-        tonality_distance, keys_graph = get_tonality_distance(neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight)
+        shortest_path_tree = cached_shortest_path_tree(neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight)
+        tonality_distance = shortest_path_tree.tonality_distance
         start_pitch=Pitch(key_selected[0].upper())
         start_mode = 'M' if key_selected[0].isupper() else 'm'
-        new_annotations = []
-        weights = []
-        text_colors = []
-        for diatonic in range(7):
-            for chromatic in range(12):
-                pitch = Pitch.from_dia_chro(diatonic,chromatic)
-                interval = Interval(start_pitch, pitch)
-                for mode in ['M','m']:
-                    shortest_path = nx.shortest_path(keys_graph,(start_pitch.diatonic,start_pitch.chromatic,start_mode),(diatonic,chromatic,mode),weight='weight')
-                    distance = tonality_distance[interval.diatonic,interval.chromatic,2*int(start_mode == 'm')+int(mode=='m')]
-                    pitch_name = pitch.name if mode == 'M' else pitch.name.lower()
-                    new_annotations.append(f'{pitch_name}<br>'\
-                                           f'Distance from {key_selected[0]}: {distance}<br>'\
-                                           f'Shortest path: {shortest_path}')
-
-                    if key_selected[0]==pitch_name or (len(key_selected)==2 and key_selected[1]==pitch_name):
-                        weights.append('bold')
-                        if mode == 'M':
-                            text_colors.append('rgba(0,0,255,1)')
-                        else:
-                            text_colors.append('rgba(255,0,0,1)')
-                    else:
-                        weights.append('normal')
-                        if mode == 'M':
-                            text_colors.append('rgba(0,0,255,0.5)')
-                        else:
-                            text_colors.append('rgba(255,0,0,0.5)')
+        start_key = (start_pitch.diatonic,start_pitch.chromatic,start_mode)
+        new_annotations = hover_annotations(shortest_path_tree, key_selected[0], start_key)
 
-        fig.update_traces(textfont = dict(weight=weights, color=text_colors),selector = dict(mode='text'))
+        weights = list(base_font_weights)
+        text_colors = list(base_text_colors)
+        for key in key_selected[:2]:
+            weights[key_positions[key]] = 'bold'
+            text_colors[key_positions[key]] = selected_text_colors[key_positions[key]]
+        patched_figure['data'][0]['textfont']['weight'] = weights
+        patched_figure['data'][0]['textfont']['color'] = text_colors
 
         if len(key_selected) == 2:
             end_pitch=Pitch(key_selected[1].upper())
             end_mode = 'M' if key_selected[1].isupper() else 'm'
-            all_shortest_paths = list(nx.all_shortest_paths(keys_graph,(start_pitch.diatonic,start_pitch.chromatic,start_mode),(end_pitch.diatonic,end_pitch.chromatic,end_mode),weight='weight'))
-            length = nx.shortest_path_length(keys_graph,(start_pitch.diatonic,start_pitch.chromatic,start_mode),(end_pitch.diatonic,end_pitch.chromatic,end_mode),weight='weight')
-            output_text = [f'There are {len(list(all_shortest_paths))} shortest paths from {key_selected[0]} to {key_selected[1]} (Total distance: {length:.1f})', html.Br()]
-            options = [{'label':f'Shortest path n°{i+1}', 'value':i} for i in range(len(all_shortest_paths))]
+            path_count = shortest_path_tree.count_paths(start_key,(end_pitch.diatonic,end_pitch.chromatic,end_mode))
+            interval = Interval(start_pitch, end_pitch)
+            length = tonality_distance[interval.diatonic,interval.chromatic,2*int(start_mode == 'm')+int(end_mode=='m')]
+            output_text = [f'There are {path_count} shortest paths from {key_selected[0]} to {key_selected[1]} (Total distance: {length:.1f})', html.Br()]
+            options = shortest_path_options(path_count, 0)
             value = 0
     else:
         new_annotations = annotations
+        patched_figure['data'][0]['textfont'] = text_font
 
-    fig.update_traces(text=new_annotations , selector = dict(mode='markers'))
-    return fig, output_text, '', options, value
+    patched_figure['data'][1]['text'] = new_annotations
+    return patched_figure, output_text, '', options, value, {'page':0, 'count':path_count}
+
+@callback(
+    Output('shortest_path_selector', 'options', allow_duplicate=True),
+    Output('shortest_path_selector', 'value', allow_duplicate=True),
+    Output('shortest_path_page', 'data', allow_duplicate=True),
+    Input('previous_paths_button', 'n_clicks'),
+    Input('next_paths_button', 'n_clicks'),
+    State('shortest_path_page', 'data'),
+    prevent_initial_call=True
+)
+def change_shortest_path_page(previous_clicks, next_clicks, shortest_path_page):
+    page_count = -(-shortest_path_page['count'] // paths_per_page)
+    page = shortest_path_page['page'] + (1 if ctx.triggered_id == 'next_paths_button' else -1)
+    if not 0 <= page < page_count:
+        return no_update
+    return shortest_path_options(shortest_path_page['count'], page), page*paths_per_page, {'page':page, 'count':shortest_path_page['count']}
 
 @callback(
     Output('keys_graph', 'figure', allow_duplicate=True),
     Output('shortest_path_descr', 'children', allow_duplicate=True),
     Input('shortest_path_selector', 'value'),
-    Input('neighbor_weight', 'value'),
-    Input('relative_weight', 'value'),
-    Input('parallel_weight', 'value'),
-    Input('enharmonic_weight', 'value'),
-    Input('dominant_weight', 'value'),
-    Input('neighbor_weight_checklist', 'value'),
-    Input('relative_weight_checklist', 'value'),
-    Input('parallel_weight_checklist', 'value'),
-    Input('enharmonic_weight_checklist', 'value'),
-    Input('dominant_weight_checklist', 'value'),
+    State('neighbor_weight', 'value'),
+    State('relative_weight', 'value'),
+    State('parallel_weight', 'value'),
+    State('enharmonic_weight', 'value'),
+    State('dominant_weight', 'value'),
+    State('neighbor_weight_checklist', 'value'),
+    State('relative_weight_checklist', 'value'),
+    State('parallel_weight_checklist', 'value'),
+    State('enharmonic_weight_checklist', 'value'),
+    State('dominant_weight_checklist', 'value'),
     State('key_selected', 'value'),
     prevent_initial_call=True
 )
 def plot_shortest_path(shortest_path_index, neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight,
                        neighbor_present, relative_present, parallel_present, enharmonic_present, dominant_present, key_selected):
+    # Weight and key changes go through update_keys_graph, which resets shortest_path_selector and thus
+    # triggers this callback once the hover text and key fonts are up to date: only the path is patched here
     neighbor_weight = neighbor_weight if neighbor_present else np.inf
     relative_weight = relative_weight if relative_present else np.inf
     parallel_weight = parallel_weight if parallel_present else np.inf
@@ -283,74 +339,29 @@ def plot_shortest_path(shortest_path_index, neighbor_weight, relative_weight, pa
     if shortest_path_index is None or shortest_path_index == -1 or len(key_selected) < 2:
         return no_update
 
-    fig = go.Figure()
-    fig.add_trace(text_trace)
-    fig.add_trace(invis_node)
-    fig.update_layout(showlegend=True)
-
-    tonality_distance, keys_graph = get_tonality_distance(neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight)
+    shortest_path_tree = cached_shortest_path_tree(neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight)
     start_pitch=Pitch(key_selected[0].upper())
     start_mode = 'M' if key_selected[0].isupper() else 'm'
+    start_key = (start_pitch.diatonic,start_pitch.chromatic,start_mode)
     end_pitch=Pitch(key_selected[1].upper())
     end_mode = 'M' if key_selected[1].isupper() else 'm'
-    new_annotations = []
-    weights = []
-    text_colors = []
-    for diatonic in range(7):
-        for chromatic in range(12):
-            pitch = Pitch.from_dia_chro(diatonic,chromatic)
-            interval = Interval(start_pitch, pitch)
-            for mode in ['M','m']:
-                shortest_path = nx.shortest_path(keys_graph,(start_pitch.diatonic,start_pitch.chromatic,start_mode),(diatonic,chromatic,mode),weight='weight')
-                distance = tonality_distance[interval.diatonic,interval.chromatic,2*int(start_mode == 'm')+int(mode=='m')]
-                pitch_name = pitch.name if mode == 'M' else pitch.name.lower()
-                new_annotations.append(f'{pitch_name}<br>'\
-                                        f'Distance from {key_selected[0]}: {distance}<br>'\
-                                        f'Shortest path: {shortest_path}')
-
-                if key_selected[0]==pitch_name or (len(key_selected)==2 and key_selected[1]==pitch_name):
-                    weights.append('bold')
-                    if mode == 'M':
-                        text_colors.append('rgba(0,0,255,1)')
-                    else:
-                        text_colors.append('rgba(255,0,0,1)')
-                else:
-                    weights.append('normal')
-                    if mode == 'M':
-                        text_colors.append('rgba(0,0,255,0.5)')
-                    else:
-                        text_colors.append('rgba(255,0,0,0.5)')
-
-    fig.update_traces(textfont = dict(weight=weights, color=text_colors),selector = dict(mode='text'))
+    end_key = (end_pitch.diatonic,end_pitch.chromatic,end_mode)
+    shortest_path, modulations = shortest_path_tree.kth_path_with_modulations(start_key,end_key,shortest_path_index)
 
-    all_shortest_paths = list(nx.all_shortest_paths(keys_graph,(start_pitch.diatonic,start_pitch.chromatic,start_mode),(end_pitch.diatonic,end_pitch.chromatic,end_mode),weight='weight'))
-    length = nx.shortest_path_length(keys_graph,(start_pitch.diatonic,start_pitch.chromatic,start_mode),(end_pitch.diatonic,end_pitch.chromatic,end_mode),weight='weight')
-    shortest_path = all_shortest_paths[shortest_path_index]
+    patched_figure = Patch()
+    patch_path(patched_figure, shortest_path, modulations)
     output_text = [html.Br()]
-    modulation_descr_names = set()
     for i in range(len(shortest_path)-1):
         u = shortest_path[i]
         v = shortest_path[i+1]
         u_pitch = Pitch.from_dia_chro(u[0],u[1])
         v_pitch = Pitch.from_dia_chro(v[0],v[1])
-        modulation_descr = keys_graph[u][v]['modulation']
-        distance = keys_graph[u][v]['weight']
-        length += distance
-        fig.add_trace(go.Scatter(
-            x = [u_pitch.chromatic+(0.3 if u[2]=='m' else 0), v_pitch.chromatic+(0.3 if v[2]=='m' else 0)],
-            y = [u_pitch.diatonic, v_pitch.diatonic],
-            mode = 'lines+markers',
-            line = dict(width=2, color = edge_color_dict[modulation_descr.split(' ')[0]],),
-            marker= dict(symbol= "arrow-bar-up", angleref="previous"),
-            hoverinfo = 'skip',
-            name = modulation_descr,
-            showlegend=modulation_descr not in modulation_descr_names
-        ))
-        modulation_descr_names.add(modulation_descr)
+        modulation_descr = modulations[i]
+        distance = shortest_path_tree.weights[MODULATION_WEIGHT_INDEX[modulation_descr]]
         output_text.append(html.Br())
         output_text.append(f'{u_pitch.name if u[2] == "M" else u_pitch.name.lower()} -> {v_pitch.name if v[2] == "M" else v_pitch.name.lower()} : {modulation_descr}')
         output_text.append(f' (distance : {distance})')
-    return fig, output_text
+    return patched_figure, output_text
 
 if __name__ == '__main__':
     app.run(debug=False, port=8051)
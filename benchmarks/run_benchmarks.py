@@ -0,0 +1,419 @@
+import argparse
+import json
+import platform
+import os
+import statistics
+import subprocess
+import sys
+import timeit
+from pathlib import Path
+
+import numpy as np
+
+from src.batch_distance import batch_tonality_distance, key_distance_matrix
+from src.distance_cache import default_cache
+from src.music_theory import Interval, Pitch, parse_keys
+from src.nearest_keys import KEY_NAMES, NearestKeysIndex
+from src.path_signatures import PathSignatureEngine
+from src.tonality_distance import DEFAULT_WEIGHTS, get_shortest_path_tree, get_tonality_distance, update_shortest_path_tree
+
+
+BASELINE_PATH = Path(__file__).with_name('baseline.json')
+DEFAULT_THRESHOLD = 0.3
+
+# Import time budgets in milliseconds: the library modules on top of numpy, and the app module on top of
+# the modules it imports (Dash itself takes most of a second to import)
+LIBRARY_MODULES = ['src.music_theory', 'src.tonality_distance', 'src.batch_distance', 'src.nearest_keys',
+                   'src.distance_cache', 'src.path_signatures', 'src.distance_tables', 'src.weight_fitting',
+                   'src.modulation_analysis']
+LIBRARY_IMPORT_BUDGET_MS = 25
+APP_IMPORT_BUDGET_MS = 60
+# Dependencies the library modules only import when they are used
+LAZY_DEPENDENCIES = ['networkx', 'plotly', 'dash', 'pandas', 'flask', 'multiprocessing']
+
+WEIGHT_SETTINGS = {
+    'default': DEFAULT_WEIGHTS,
+    'app_default': (1, 0.7, 1.3, 0.01, 1.2),
+    'no_enharmonic': (1, 0.7, 1.3, np.inf, 1.2),
+    'neighbor_only': (1, np.inf, np.inf, np.inf, np.inf),
+}
+
+BENCHMARKS = {}
+CHECKS = {}
+
+
+def benchmark(name):
+    """
+    Registers a benchmark: the decorated function does the setup and returns the callable to time,
+    optionally with a dict of extra figures to report alongside the timings.
+    """
+    def register(make):
+        BENCHMARKS[name] = make
+        return make
+    return register
+
+
+def check(name):
+    """
+    Registers a correctness check: the decorated function returns (passed, detail).
+    """
+    def register(function):
+        CHECKS[name] = function
+        return function
+    return register
+
+
+def _random_weights(count, seed = 0):
+    """
+    Returns count weight settings drawn like slider values, a fifth of the weights being disabled.
+    """
+    rng = np.random.default_rng(seed)
+    weights = rng.integers(1, 100, (count, 5)) / 10
+    weights[rng.random((count, 5)) < 0.2] = np.inf
+    return [tuple(w) for w in weights.tolist()] + list(WEIGHT_SETTINGS.values())
+
+
+# Engine
+
+for _setting, _weights in WEIGHT_SETTINGS.items():
+    for _engine in ('networkx', 'numpy'):
+        benchmark(f'engine.get_tonality_distance.{_engine}.{_setting}')(
+            lambda weights=_weights, engine=_engine: lambda: get_tonality_distance(*weights, engine=engine))
+
+
+@benchmark('engine.get_shortest_path_tree.default')
+def _shortest_path_tree():
+    return lambda: get_shortest_path_tree(*WEIGHT_SETTINGS['default'])
+
+
+@benchmark('engine.update_shortest_path_tree.one_weight')
+def _update_shortest_path_tree():
+    tree = get_shortest_path_tree(*WEIGHT_SETTINGS['default'])
+    return lambda: update_shortest_path_tree(tree, 1, 0.7, 1.4, 0.5, 1.2)
+
+
+@benchmark('engine.path_signatures.1024_weights')
+def _path_signatures():
+    engine = PathSignatureEngine()
+    weights = np.array(_random_weights(1024))[:1024]
+    return lambda: engine.batch_tonality_distance(weights)
+
+
+@benchmark('engine.batch_tonality_distance.1M_pairs')
+def _batch_tonality_distance():
+    matrix = key_distance_matrix(get_tonality_distance(engine='numpy')[0])
+    rng = np.random.default_rng(0)
+    keys_from, keys_to = rng.integers(0, 168, (2, 1_000_000))
+    return lambda: batch_tonality_distance(matrix, keys_from, keys_to)
+
+
+@benchmark('nearest_keys.build')
+def _nearest_keys_build():
+    tree = get_shortest_path_tree(*WEIGHT_SETTINGS['default'])
+    return lambda: NearestKeysIndex(tree)
+
+
+@benchmark('nearest_keys.nearest.5')
+def _nearest_keys_nearest():
+    index = NearestKeysIndex(get_shortest_path_tree(*WEIGHT_SETTINGS['default']))
+    return lambda: index.nearest('g', 5)
+
+
+@benchmark('nearest_keys.within.2')
+def _nearest_keys_within():
+    index = NearestKeysIndex(get_shortest_path_tree(*WEIGHT_SETTINGS['default']))
+    return lambda: index.within('E-', 2.0)
+
+
+@benchmark('nearest_keys.nearest_many.10k_sources.5')
+def _nearest_keys_nearest_many():
+    index = NearestKeysIndex(get_shortest_path_tree(*WEIGHT_SETTINGS['default']))
+    sources = np.random.default_rng(0).integers(0, 168, 10_000)
+    return lambda: index.nearest_many(sources, 5)
+
+
+# music_theory primitives
+
+_pitch_names = [Pitch.from_packed(packed).name for packed in range(84)]
+
+
+@benchmark('music_theory.Pitch.84_names')
+def _pitch():
+    return lambda: [Pitch(name) for name in _pitch_names]
+
+
+@benchmark('music_theory.Pitch.from_dia_chro.84')
+def _from_dia_chro():
+    return lambda: [Pitch.from_dia_chro(diatonic, chromatic) for diatonic in range(7) for chromatic in range(12)]
+
+
+@benchmark('music_theory.Interval.84')
+def _interval():
+    start = Pitch('C')
+    pitches = [Pitch.from_packed(packed) for packed in range(84)]
+    return lambda: [Interval(start, pitch) for pitch in pitches]
+
+
+@benchmark('music_theory.Pitch.__add__.84')
+def _add():
+    pitch = Pitch('E-')
+    intervals = [Interval(Pitch('C'), Pitch.from_packed(packed)) for packed in range(84)]
+    return lambda: [pitch + interval for interval in intervals]
+
+
+@benchmark('music_theory.parse_keys.100k_labels')
+def _parse_keys():
+    labels = np.random.default_rng(0).choice(['C', 'f#', 'B-', 'g', 'Eb', 'a', 'D', 'c#'], 100_000)
+    return lambda: parse_keys(labels)
+
+
+# Dash callbacks, called directly. The shortest path trees are cached as in the app, except for the cold variant.
+
+def _callback_inputs(weights = (1, 0.7, 1.3, 0.01, 1.2)):
+    return list(weights) + [['Neighbor weight:'], ['Relative weight:'], ['Parallel weight:'], ['Enharmonic weight:'], ['Dominant weight:']]
+
+
+def _payload_bytes(output):
+    import plotly.io
+    return len(plotly.io.json.to_json_plotly(output))
+
+
+def _update_keys_graph(keys, cold = False):
+    from Tonality_distance_calculator import update_keys_graph
+    inputs = _callback_inputs()
+    extra = {'bytes': _payload_bytes(update_keys_graph(keys, *inputs))}
+    if cold:
+        def call():
+            default_cache.clear()
+            return update_keys_graph(keys, *inputs)
+        return call, extra
+    return (lambda: update_keys_graph(keys, *inputs)), extra
+
+
+benchmark('callbacks.update_keys_graph.no_key')(lambda: _update_keys_graph([]))
+benchmark('callbacks.update_keys_graph.one_key')(lambda: _update_keys_graph(['C']))
+benchmark('callbacks.update_keys_graph.two_keys')(lambda: _update_keys_graph(['C', 'f#']))
+benchmark('callbacks.update_keys_graph.two_keys_cold')(lambda: _update_keys_graph(['C', 'f#'], cold=True))
+
+
+@benchmark('callbacks.plot_shortest_path.two_keys')
+def _plot_shortest_path():
+    from Tonality_distance_calculator import plot_shortest_path
+    inputs = _callback_inputs() + [['C', 'f#']]
+    extra = {'bytes': _payload_bytes(plot_shortest_path(0, *inputs))}
+    return (lambda: plot_shortest_path(0, *inputs)), extra
+
+
+# Correctness of the alternative engines against the networkx reference tensor
+
+def _compare(name, compute, exact = True, count = 50):
+    worst = 0.0
+    for weights in _random_weights(count):
+        reference = get_tonality_distance(*weights)[0]
+        result = np.asarray(compute(weights))
+        if exact:
+            if not np.array_equal(result, reference):
+                return False, f'{name} differs from networkx for weights {weights}'
+        else:
+            if not np.array_equal(np.isinf(result), np.isinf(reference)):
+                return False, f'{name} disables other entries than networkx for weights {weights}'
+            finite = np.isfinite(reference)
+            worst = max(worst, float(np.max(np.abs(result[finite] - reference[finite]) / np.maximum(reference[finite], 1))))
+            if worst > 1e-12:
+                return False, f'{name} is off by {worst:.3g} for weights {weights}'
+    return True, f'{count + len(WEIGHT_SETTINGS)} weight settings, largest relative error {worst:.3g}'
+
+
+@check('numpy_engine')
+def _check_numpy_engine():
+    return _compare('The numpy engine', lambda weights: get_tonality_distance(*weights, engine='numpy')[0])
+
+
+@check('shortest_path_tree')
+def _check_shortest_path_tree():
+    return _compare('get_shortest_path_tree', lambda weights: get_shortest_path_tree(*weights).tonality_distance)
+
+
+@check('update_shortest_path_tree')
+def _check_update_shortest_path_tree():
+    tree = get_shortest_path_tree(*WEIGHT_SETTINGS['default'])
+
+    def update(weights):
+        nonlocal tree
+        # Move one weight at a time towards the target, as a slider would
+        for i in range(5):
+            tree = update_shortest_path_tree(tree, *(weights[:i + 1] + tree.weights[i + 1:]))
+        return tree.tonality_distance
+    return _compare('update_shortest_path_tree', update)
+
+
+@check('path_signatures')
+def _check_path_signatures():
+    engine = PathSignatureEngine()
+    return _compare('PathSignatureEngine', lambda weights: engine.tonality_distance(*weights), exact=False)
+
+
+@check('batch_tonality_distance')
+def _check_batch_tonality_distance():
+    def batch(weights):
+        # Distances from every key of the reference layout (C and c) through the packed key API
+        dia, chro, mode = np.unravel_index(np.arange(168), (7, 12, 2))
+        tensor = np.empty((7, 12, 4))
+        for source_mode in range(2):
+            tensor[dia, chro, 2 * source_mode + mode] = batch_tonality_distance(
+                get_tonality_distance(*weights, engine='numpy')[0], (0, 0, source_mode), (dia, chro, mode))
+        return tensor
+    return _compare('batch_tonality_distance', batch, count=10)
+
+
+@check('nearest_keys')
+def _check_nearest_keys():
+    # Every source key of every weight setting against a full sort of its row of the distance matrix
+    for weights in _random_weights(20):
+        tree = get_shortest_path_tree(*weights)
+        index = NearestKeysIndex(tree)
+        matrix = key_distance_matrix(tree.tonality_distance)
+        neighbors, distance = index.nearest_many(np.arange(168), 167)
+        for source in range(168):
+            row = np.delete(matrix[source], source)
+            expected = np.sort(row[np.isfinite(row)])
+            found = neighbors[source][neighbors[source] >= 0]
+            if not np.array_equal(distance[source][:len(found)], expected) or not np.array_equal(matrix[source, found], expected):
+                return False, f'nearest_many differs from a full sort from {KEY_NAMES[source]} for weights {weights}'
+            if len(set(found.tolist()) | {source}) != len(found) + 1:
+                return False, f'nearest_many repeats keys from {KEY_NAMES[source]} for weights {weights}'
+        for source in range(0, 168, 17):
+            row = np.delete(matrix[source], source)
+            for radius in (0.5, 1.0, 2.0, 3.7):
+                within = index.within(source, radius)
+                names = [name for name, _, _ in within]
+                if len(within) != np.count_nonzero(row <= radius + 1e-9) or names != KEY_NAMES[neighbors[source][:len(within)]].tolist():
+                    return False, f'within {radius} differs from a full sort from {KEY_NAMES[source]} for weights {weights}'
+    return True, f'{20 + len(WEIGHT_SETTINGS)} weight settings, 168 source keys each'
+
+
+# Import time, measured in fresh interpreters
+
+def _python(code, *options):
+    # Bytecode is written by a first run, so that the timed runs do not compile the modules
+    environment = {key: value for key, value in os.environ.items() if key != 'PYTHONDONTWRITEBYTECODE'}
+    return subprocess.run([sys.executable, *options, '-c', code], cwd=Path(__file__).parent.parent, env=environment,
+                          capture_output=True, text=True, check=True)
+
+
+def _library_import():
+    imports = '; '.join(f'import {module}' for module in LIBRARY_MODULES)
+    output = _python(f'import sys, time, numpy\nstart = time.perf_counter()\n{imports}\n'
+                     f'print(time.perf_counter() - start, *[name for name in {LAZY_DEPENDENCIES!r} if name in sys.modules])').stdout.split()
+    return float(output[0]) * 1000, output[1:]
+
+
+def _app_import():
+    # -X importtime reports the time spent in the module itself, excluding the modules it imports
+    for line in _python('import Tonality_distance_calculator', '-X', 'importtime').stderr.splitlines():
+        self_time, _, module = line.removeprefix('import time:').split('|')
+        if module.strip() == 'Tonality_distance_calculator':
+            return int(self_time) / 1000
+
+
+@check('import_time')
+def _check_import_time(runs = 5):
+    _library_import()
+    library = min(_library_import() for _ in range(runs))
+    app = min(_app_import() for _ in range(runs))
+    detail = f'library modules {library[0]:.1f} ms (budget {LIBRARY_IMPORT_BUDGET_MS}), app module {app:.1f} ms (budget {APP_IMPORT_BUDGET_MS})'
+    if library[1]:
+        return False, f'importing the library modules imports {", ".join(library[1])}'
+    return library[0] <= LIBRARY_IMPORT_BUDGET_MS and app <= APP_IMPORT_BUDGET_MS, detail
+
+
+def time_benchmark(function, repeat = 5, min_time = 0.2):
+    """
+    Returns the best and median time per call in microseconds over repeat runs of at least min_time seconds.
+    """
+    timer = timeit.Timer(function)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2 if number < 4 else 4
+    times = [time / number * 1e6 for time in timer.repeat(repeat, number)]
+    return {'best_us': min(times), 'median_us': statistics.median(times), 'number': number}
+
+
+def run(name_filter = None, repeat = 5, min_time = 0.2, correctness = True):
+    results = {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+               'benchmarks': {}, 'correctness': {}}
+    for name, make in BENCHMARKS.items():
+        if name_filter and name_filter not in name:
+            continue
+        made = make()
+        function, extra = made if isinstance(made, tuple) else (made, {})
+        results['benchmarks'][name] = {**time_benchmark(function, repeat, min_time), **extra}
+        print(f'{name:<55} {results["benchmarks"][name]["best_us"]:>12.2f} us', file=sys.stderr)
+    if correctness:
+        for name, function in CHECKS.items():
+            passed, detail = function()
+            results['correctness'][name] = {'passed': passed, 'detail': detail}
+            print(f'{name:<55} {"ok" if passed else "FAILED"}: {detail}', file=sys.stderr)
+    return results
+
+
+def compare_to_baseline(results, baseline, threshold = None):
+    """
+    Returns the benchmarks whose best time grew by more than their threshold relative to the baseline.
+    The threshold is taken from the argument, else from the per-benchmark thresholds of the baseline file,
+    else from its default threshold.
+    """
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        reference = baseline['benchmarks'].get(name)
+        if reference is None:
+            continue
+        limit = threshold if threshold is not None else baseline.get('thresholds', {}).get(name, baseline.get('threshold', DEFAULT_THRESHOLD))
+        ratio = result['best_us'] / reference['best_us']
+        result['baseline_ratio'] = ratio
+        if ratio > 1 + limit:
+            regressions.append({'name': name, 'ratio': ratio, 'threshold': limit})
+    return regressions
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the tonality distance code (python -m benchmarks.run_benchmarks).')
+    parser.add_argument('--output', default=None, help='JSON file for the results, - for stdout')
+    parser.add_argument('--baseline', default=str(BASELINE_PATH), help='baseline JSON file to compare against')
+    parser.add_argument('--update-baseline', action='store_true', help='write the results as the new baseline, keeping its thresholds')
+    parser.add_argument('--threshold', type=float, default=None, help='allowed relative slowdown, overriding the baseline thresholds')
+    parser.add_argument('-k', '--filter', default=None, help='only run the benchmarks whose name contains this string')
+    parser.add_argument('--quick', action='store_true', help='fewer and shorter runs, for a rough check')
+    parser.add_argument('--skip-correctness', action='store_true', help='do not compare the engines against networkx')
+    args = parser.parse_args(argv)
+
+    repeat, min_time = (3, 0.05) if args.quick else (5, 0.2)
+    results = run(args.filter, repeat, min_time, not args.skip_correctness)
+
+    baseline_path = Path(args.baseline)
+    baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() else None
+    results['regressions'] = compare_to_baseline(results, baseline, args.threshold) if baseline else []
+    for regression in results['regressions']:
+        print(f'Regression: {regression["name"]} is {regression["ratio"]:.2f}x the baseline (threshold {1 + regression["threshold"]:.2f}x)', file=sys.stderr)
+
+    if args.output == '-':
+        print(json.dumps(results, indent=2))
+    elif args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    if args.update_baseline:
+        thresholds = {key: baseline[key] for key in ('threshold', 'thresholds') if baseline and key in baseline}
+        new_baseline = {'threshold': DEFAULT_THRESHOLD, 'thresholds': {}, **thresholds,
+                        'python': results['python'], 'numpy': results['numpy'], 'machine': results['machine'],
+                        'benchmarks': {name: {'best_us': result['best_us'], 'median_us': result['median_us']}
+                                       for name, result in results['benchmarks'].items()}}
+        if baseline and args.filter:
+            new_baseline['benchmarks'] = {**baseline['benchmarks'], **new_baseline['benchmarks']}
+        baseline_path.write_text(json.dumps(new_baseline, indent=2) + '\n')
+
+    failed = [name for name, result in results['correctness'].items() if not result['passed']]
+    if results['regressions'] or failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import numpy as np
+
+from src.music_theory import parse_keys
+
+
+def _reduce(values, modulo):
+    # The modulo is only paid for when some values are actually out of range
+    if values.size and (values.min() < 0 or values.max() >= modulo):
+        return values % modulo
+    return values
+
+
+def encode_keys(keys):
+    """
+    Returns keys as an integer array of packed key indices (diatonic * 12 + chromatic) * 2 + mode,
+    the layout of key_index, mode being 0 for major and 1 for minor.
+
+    keys is either a tuple of three array-likes (diatonic, chromatic, mode), an integer array of packed
+    key indices, or a sequence / array of key names, uppercase for major and lowercase for minor keys.
+    Rows set to -1 by parse_keys(errors='coerce') are encoded as -1. Packed indices outside 0..167 and
+    modes other than 0 and 1 raise a ValueError.
+    """
+    if isinstance(keys, tuple) and len(keys) == 3 and not isinstance(keys[0], str):
+        dia, chro, mode = (np.asarray(x, dtype=np.intp) for x in keys)
+        packed = _reduce(dia, 7) * 24
+        packed += _reduce(chro, 12) * 2
+        packed += mode
+        if mode.size and (mode.min() < 0 or mode.max() > 1):
+            missing = (dia == -1) & (chro == -1) & (mode == -1)
+            invalid = ~missing & (mode != 0) & (mode != 1)
+            if invalid.any():
+                modes = np.unique(np.broadcast_to(mode, invalid.shape)[invalid])
+                raise ValueError(f'Invalid modes {modes.tolist()}: expected 0 for major or 1 for minor')
+            packed = np.where(missing, -1, packed)
+        return packed
+    keys = np.asarray(keys)
+    if keys.dtype.kind in 'iu':
+        if keys.size and (keys.min() < 0 or keys.max() >= 168):
+            invalid = np.unique(keys[(keys < 0) | (keys >= 168)])
+            raise ValueError(f'Invalid packed key indices {invalid[:10].tolist()}: expected 0 to 167')
+        return keys
+    return encode_keys(parse_keys(keys))
+
+
+def key_distance_matrix(tonality_distance):
+    """
+    Returns the 168x168 matrix of distances between every pair of packed key indices.
+    tonality_distance is the 7x12x4 tensor of get_tonality_distance, or any array laid out the same way.
+    """
+    dia, chro, mode = np.unravel_index(np.arange(168), (7, 12, 2))
+    interval = ((dia - dia[:, None]) % 7 * 12 + (chro - chro[:, None]) % 12) * 4
+    return np.asarray(tonality_distance).ravel()[interval + 2 * mode[:, None] + mode]
+
+
+def _pair_index(keys_from, keys_to):
+    # Flat index of every pair in the 168x168 matrix, and the mask of the pairs with a missing key
+    # (None when there is none)
+    packed_from, packed_to = encode_keys(keys_from), encode_keys(keys_to)
+    index = packed_from * 168
+    index = index + packed_to
+    if packed_from.min(initial=0) < 0 or packed_to.min(initial=0) < 0:
+        return index, (packed_from < 0) | (packed_to < 0)
+    return index, None
+
+
+def batch_tonality_distance(tonality_distance, keys_from, keys_to):
+    """
+    Returns the distances from keys_from to keys_to, pairwise, as a float array, NaN for missing keys.
+
+    tonality_distance is either the 7x12x4 tensor of get_tonality_distance or the matrix of
+    key_distance_matrix, which saves rebuilding it when querying the same weights in several batches.
+    keys_from and keys_to are given in any form accepted by encode_keys and broadcast against each other.
+    """
+    tonality_distance = np.asarray(tonality_distance)
+    if tonality_distance.shape != (168, 168):
+        tonality_distance = key_distance_matrix(tonality_distance)
+    index, missing = _pair_index(keys_from, keys_to)
+    if missing is not None:
+        return np.where(missing, np.nan, tonality_distance.ravel().take(np.where(missing, 0, index)))
+    return tonality_distance.ravel().take(index)
+
+
+_entry_matrix = key_distance_matrix(np.arange(336).reshape(7, 12, 4))
+
+
+def tensor_entries(keys_from, keys_to):
+    """
+    Returns the indices in the flattened 7x12x4 tensor of the distances from keys_from to keys_to,
+    given in any form accepted by encode_keys. Missing keys have no entry and raise a ValueError.
+    """
+    index, missing = _pair_index(keys_from, keys_to)
+    if missing is not None:
+        raise ValueError(f'{np.count_nonzero(missing)} pairs of keys have a missing key')
+    return _entry_matrix.ravel().take(index)
@@ -0,0 +1,230 @@
+import math
+import threading
+from collections import OrderedDict
+
+from src.nearest_keys import NearestKeysIndex
+from src.tonality_distance import get_tonality_distance, get_shortest_path_tree, update_shortest_path_tree
+
+
+class _ReadOnlyDict(dict):
+    """
+    Attribute dict of a cached graph: reads like a dict and raises TypeError on writes. Pickling and copying
+    give a plain dict, so cached graphs can be sent to worker processes and their copies can be modified.
+    """
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('Cached graphs are read-only, modify a copy of the graph')
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
+def _deep_freeze(keys_graph):
+    """
+    Returns the graph frozen by nx.freeze, with read-only node, edge and graph attributes: nx.freeze only
+    blocks adding and removing nodes and edges.
+    """
+    import networkx as nx
+
+    keys_graph = nx.freeze(keys_graph)
+    keys_graph.graph = _ReadOnlyDict(keys_graph.graph)
+    for node, data in keys_graph._node.items():
+        keys_graph._node[node] = _ReadOnlyDict(data)
+    # A directed graph shares every edge attribute dict between its successor and predecessor adjacency
+    for source, targets in keys_graph._adj.items():
+        for target, data in targets.items():
+            targets[target] = _ReadOnlyDict(data)
+            if keys_graph.is_directed():
+                keys_graph._pred[target][source] = targets[target]
+    return keys_graph
+
+
+def normalize_weight(weight):
+    """
+    Returns the weight as a float usable in a cache key.
+    Slider values such as 0.30000000000000004 are rounded so that they share the entry of 0.3,
+    disabled modulation types keep their np.inf weight.
+    """
+    weight = float(weight)
+    if math.isnan(weight):
+        raise ValueError('Modulation weights cannot be NaN')
+    return weight if math.isinf(weight) else round(weight, 9)
+
+
+def normalize_weights(neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight):
+    """
+    Returns the weights as a tuple of floats usable as a cache key, see normalize_weight.
+    """
+    return tuple(normalize_weight(weight) for weight in (neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight))
+
+
+# Kinds of cache entries: tonality distance tensors (with their graph), shortest path trees and nearest keys indexes
+ENTRY_KINDS = ('tensor', 'tree', 'nearest')
+
+
+def _entry_kind(key):
+    # Keys are the normalized weights followed by the engine of a tensor, 'tree' or 'nearest'
+    return key[5] if key[5] in ('tree', 'nearest') else 'tensor'
+
+
+class TonalityDistanceCache:
+    """
+    Bounded, thread-safe memoization of get_tonality_distance, get_shortest_path_tree and NearestKeysIndex keyed on the normalized weights.
+
+    eviction is either 'lru' (least recently used entry is dropped) or 'fifo' (oldest entry is dropped).
+    Cached arrays are read-only and cached graphs are frozen down to their attributes, so callers cannot corrupt an entry.
+    A missing shortest path tree is updated from the last requested one with update_shortest_path_tree,
+    which is faster when a single weight changed, as when dragging a slider.
+    Hits and misses are counted per kind of entry (see ENTRY_KINDS): building a missing NearestKeysIndex
+    looks up its shortest path tree, which counts as a tree hit or miss of its own.
+    """
+    def __init__(self, maxsize = 128, eviction = 'lru'):
+        if maxsize < 1:
+            raise ValueError(f'Invalid cache size: {maxsize}')
+        if eviction not in ('lru', 'fifo'):
+            raise ValueError(f'Invalid eviction policy: {eviction}')
+        self.maxsize = maxsize
+        self.eviction = eviction
+        self.hits = dict.fromkeys(ENTRY_KINDS, 0)
+        self.misses = dict.fromkeys(ENTRY_KINDS, 0)
+        self._entries = OrderedDict()
+        self._last_tree = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_tonality_distance(self, neighbor_weight = 1,
+                              relative_weight = 0.7,
+                              parallel_weight = 1.3,
+                              enharmonic_weight = 0.5,
+                              dominant_weight = 1.2,
+                              engine = 'networkx'):
+        """
+        Same as get_tonality_distance, served from the cache when these weights were already computed.
+        """
+        weights = normalize_weights(neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight)
+        return self._lookup(weights + (engine,), lambda: self._compute_tonality_distance(weights, engine))
+
+    def get_shortest_path_tree(self, neighbor_weight = 1,
+                               relative_weight = 0.7,
+                               parallel_weight = 1.3,
+                               enharmonic_weight = 0.5,
+                               dominant_weight = 1.2):
+        """
+        Same as get_shortest_path_tree, served from the cache when these weights were already computed.
+        """
+        weights = normalize_weights(neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight)
+        previous = self._last_tree
+        tree = self._lookup(weights + ('tree',), lambda: self._compute_shortest_path_tree(weights, previous))
+        self._last_tree = tree
+        return tree
+
+    def get_nearest_keys_index(self, neighbor_weight = 1,
+                               relative_weight = 0.7,
+                               parallel_weight = 1.3,
+                               enharmonic_weight = 0.5,
+                               dominant_weight = 1.2):
+        """
+        Returns the NearestKeysIndex of these weights, built from the cached shortest path tree.
+        """
+        weights = normalize_weights(neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight)
+        return self._lookup(weights + ('nearest',), lambda: NearestKeysIndex(self.get_shortest_path_tree(*weights)))
+
+    @staticmethod
+    def _compute_tonality_distance(weights, engine):
+        tonality_distance, keys_graph = get_tonality_distance(*weights, engine=engine)
+        tonality_distance.flags.writeable = False
+        if keys_graph is not None:
+            keys_graph = _deep_freeze(keys_graph)
+        return tonality_distance, keys_graph
+
+    @staticmethod
+    def _compute_shortest_path_tree(weights, previous):
+        if previous is None:
+            tree = get_shortest_path_tree(*weights)
+        else:
+            tree = update_shortest_path_tree(previous, *weights)
+        for array in (tree.tonality_distance, tree.predecessor, tree.modulation, tree.dag, tree.order, tree.hops):
+            array.flags.writeable = False
+        return tree
+
+    def _lookup(self, key, compute):
+        kind = _entry_kind(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits[kind] += 1
+                if self.eviction == 'lru':
+                    self._entries.move_to_end(key)
+                return entry
+            self.misses[kind] += 1
+
+        entry = compute()
+
+        with self._lock:
+            # Another thread may have computed the same weights meanwhile, keep the first entry
+            entry = self._entries.setdefault(key, entry)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry
+
+    def info(self):
+        """
+        Returns the hit and miss counters along with the current and maximum size, in total and per kind of entry.
+        """
+        with self._lock:
+            sizes = dict.fromkeys(ENTRY_KINDS, 0)
+            for key in self._entries:
+                sizes[_entry_kind(key)] += 1
+            kinds = {kind: {'hits': self.hits[kind], 'misses': self.misses[kind], 'size': sizes[kind]} for kind in ENTRY_KINDS}
+            return {'hits': sum(self.hits.values()), 'misses': sum(self.misses.values()), 'size': len(self._entries),
+                    'maxsize': self.maxsize, 'kinds': kinds}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._last_tree = None
+            self.hits = dict.fromkeys(ENTRY_KINDS, 0)
+            self.misses = dict.fromkeys(ENTRY_KINDS, 0)
+
+
+default_cache = TonalityDistanceCache()
+
+
+def cached_tonality_distance(neighbor_weight = 1,
+                             relative_weight = 0.7,
+                             parallel_weight = 1.3,
+                             enharmonic_weight = 0.5,
+                             dominant_weight = 1.2,
+                             engine = 'networkx'):
+    """
+    get_tonality_distance memoized in the module-level default_cache.
+    """
+    return default_cache.get_tonality_distance(neighbor_weight, relative_weight, parallel_weight,
+                                               enharmonic_weight, dominant_weight, engine=engine)
+
+
+def cached_shortest_path_tree(neighbor_weight = 1,
+                              relative_weight = 0.7,
+                              parallel_weight = 1.3,
+                              enharmonic_weight = 0.5,
+                              dominant_weight = 1.2):
+    """
+    get_shortest_path_tree memoized in the module-level default_cache.
+    """
+    return default_cache.get_shortest_path_tree(neighbor_weight, relative_weight, parallel_weight,
+                                                enharmonic_weight, dominant_weight)
+
+
+def cached_nearest_keys_index(neighbor_weight = 1,
+                              relative_weight = 0.7,
+                              parallel_weight = 1.3,
+                              enharmonic_weight = 0.5,
+                              dominant_weight = 1.2):
+    """
+    NearestKeysIndex of the weights memoized in the module-level default_cache.
+    """
+    return default_cache.get_nearest_keys_index(neighbor_weight, relative_weight, parallel_weight,
+                                                enharmonic_weight, dominant_weight)
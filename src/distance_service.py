@@ -0,0 +1,280 @@
+import argparse
+import functools
+import json
+import math
+import os
+import signal
+import sys
+
+import numpy as np
+from flask import Blueprint, Flask, Response, request
+from werkzeug.exceptions import HTTPException
+from werkzeug.serving import make_server
+
+from src.batch_distance import batch_tonality_distance, key_distance_matrix
+from src.distance_cache import cached_shortest_path_tree, normalize_weights
+from src.distance_tables import DistanceTables
+from src import instrumentation
+from src.music_theory import Pitch, parse_keys
+from src.tonality_distance import DEFAULT_WEIGHTS, MODES
+
+
+max_batch_size = 1_000_000
+max_paths = 100
+
+distance_api = Blueprint('distance_api', __name__, url_prefix='/api')
+
+# Precomputed tables of src/distance_tables.py, set by use_distance_tables
+distance_tables = None
+
+
+def use_distance_tables(path):
+    """
+    Serves the tensors of the weights on the grid of the table file at path from its memory mapping, and their
+    shortest paths if the file was built with paths.
+    """
+    global distance_tables
+    distance_tables = DistanceTables(path)
+
+
+def parse_weights(weights):
+    """
+    Returns the normalized weights of a 'neighbor,relative,parallel,enharmonic,dominant' query string
+    or of a JSON list of 5 numbers. inf (null in JSON) disables a modulation type, None gives the defaults.
+    """
+    if weights is None:
+        return normalize_weights(*DEFAULT_WEIGHTS)
+    if isinstance(weights, str):
+        weights = weights.split(',')
+    if not isinstance(weights, list) or len(weights) != 5:
+        raise ValueError('weights must list the 5 modulation weights: neighbor, relative, parallel, enharmonic, dominant')
+    try:
+        weights = normalize_weights(*[math.inf if weight is None else weight for weight in weights])
+    except TypeError:
+        raise ValueError('Modulation weights must be numbers') from None
+    if min(weights) <= 0:
+        raise ValueError('Modulation weights must be positive')
+    return weights
+
+
+def _parse_key(label):
+    diatonic, chromatic, mode = parse_keys([label])
+    return int(diatonic[0]), int(chromatic[0]), MODES[mode[0]]
+
+
+def _key_name(key):
+    diatonic, chromatic, mode = key
+    name = Pitch.from_dia_chro(diatonic, chromatic).name
+    return name if mode == 'M' else name.lower()
+
+
+def _json_weights(weights):
+    return [None if math.isinf(weight) else weight for weight in weights]
+
+
+def _json_distances(distances):
+    # JSON has no infinity nor NaN: keys only reachable through disabled modulation types and missing keys
+    # get null
+    if not np.isfinite(distances).all():
+        return np.where(np.isfinite(distances), distances, None).tolist()
+    return distances.tolist()
+
+
+def _tonality_distance(weights):
+    if distance_tables is not None:
+        tonality_distance = distance_tables.lookup(*weights)
+        if tonality_distance is not None:
+            return tonality_distance
+    return cached_shortest_path_tree(*weights).tonality_distance
+
+
+def _shortest_path_tree(weights):
+    if distance_tables is not None:
+        tree = distance_tables.shortest_path_tree(*weights)
+        if tree is not None:
+            return tree
+    return cached_shortest_path_tree(*weights)
+
+
+@functools.lru_cache(maxsize=128)
+def _distance_matrix(weights):
+    matrix = key_distance_matrix(_tonality_distance(weights))
+    matrix.flags.writeable = False
+    return matrix
+
+
+@functools.lru_cache(maxsize=4096)
+def distance_response(weights, key_from, key_to):
+    """
+    Returns the JSON body of /api/distance. Bodies of the GET endpoints are memoized per process.
+    """
+    distance = batch_tonality_distance(_distance_matrix(weights), [key_from], [key_to])
+    return json.dumps({'from': key_from, 'to': key_to, 'weights': _json_weights(weights), 'distance': _json_distances(distance)[0]})
+
+
+@functools.lru_cache(maxsize=4096)
+def path_response(weights, key_from, key_to, offset, limit):
+    """
+    Returns the JSON body of /api/path.
+    """
+    tree = _shortest_path_tree(weights)
+    start, end = _parse_key(key_from), _parse_key(key_to)
+    count = tree.count_paths(start, end)
+    paths = []
+    for k in range(offset, min(count, offset + limit)):
+        keys, modulations = tree.kth_path_with_modulations(start, end, k)
+        paths.append({'keys': [_key_name(key) for key in keys], 'modulations': modulations})
+    distance = batch_tonality_distance(_distance_matrix(weights), [key_from], [key_to])
+    return json.dumps({'from': key_from, 'to': key_to, 'weights': _json_weights(weights), 'distance': _json_distances(distance)[0],
+                       'count': count, 'offset': offset, 'paths': paths})
+
+
+@functools.lru_cache(maxsize=128)
+def tensor_response(weights):
+    """
+    Returns the JSON body of /api/tensor.
+    """
+    tonality_distance = _tonality_distance(weights)
+    return json.dumps({'weights': _json_weights(weights), 'tensor': _json_distances(tonality_distance)})
+
+
+def _json_response(body, status = 200):
+    return Response(body, status=status, mimetype='application/json')
+
+
+@distance_api.errorhandler(ValueError)
+def _bad_request(error):
+    return _json_response(json.dumps({'error': str(error)}), 400)
+
+
+@distance_api.errorhandler(KeyError)
+def _missing_parameter(error):
+    return _json_response(json.dumps({'error': f'Missing parameter {error.args[0]!r}'}), 400)
+
+
+@distance_api.errorhandler(HTTPException)
+def _http_error(error):
+    if isinstance(error, KeyError):
+        return _missing_parameter(error)
+    return _json_response(json.dumps({'error': error.description}), error.code)
+
+
+@distance_api.get('/distance')
+def distance():
+    """
+    GET /api/distance?from=C&to=f%23&weights=1,0.7,1.3,0.5,1.2
+    """
+    weights = parse_weights(request.args.get('weights'))
+    return _json_response(distance_response(weights, request.args['from'], request.args['to']))
+
+
+@distance_api.post('/distances')
+def distances():
+    """
+    POST /api/distances with a JSON body {"from": [...], "to": [...], "weights": [...]}, the key lists
+    being broadcast against each other as in batch_tonality_distance.
+    """
+    query = request.get_json()
+    if not isinstance(query, dict):
+        raise ValueError('The body must be a JSON object with "from", "to" and optionally "weights"')
+    weights = parse_weights(query.get('weights'))
+    keys_from, keys_to = np.asarray(query['from']), np.asarray(query['to'])
+    # The batch is the broadcast of the key lists: 1000 keys against 1000 keys broadcast to 1000x1000 pairs
+    if math.prod(np.broadcast_shapes(keys_from.shape, keys_to.shape)) > max_batch_size:
+        raise ValueError(f'Batches are limited to {max_batch_size} pairs of keys')
+    distances = batch_tonality_distance(_distance_matrix(weights), keys_from, keys_to)
+    return _json_response(json.dumps({'weights': _json_weights(weights), 'distances': _json_distances(distances)}))
+
+
+@distance_api.get('/path')
+def path():
+    """
+    GET /api/path?from=C&to=f%23&offset=0&limit=1&weights=... lists the shortest paths from offset on.
+    """
+    weights = parse_weights(request.args.get('weights'))
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', 1, type=int)
+    if offset < 0 or not 0 <= limit <= max_paths:
+        raise ValueError(f'offset must be positive and limit between 0 and {max_paths}')
+    return _json_response(path_response(weights, request.args['from'], request.args['to'], offset, limit))
+
+
+@distance_api.get('/tensor')
+def tensor():
+    """
+    GET /api/tensor?weights=... returns the 7x12x4 tensor of get_tonality_distance.
+    """
+    return _json_response(tensor_response(parse_weights(request.args.get('weights'))))
+
+
+def preload(weights = DEFAULT_WEIGHTS):
+    """
+    Computes the tables of the default weights, so that forked workers start with them.
+    """
+    weights = normalize_weights(*weights)
+    _distance_matrix(weights)
+    tensor_response(weights)
+
+
+def create_app(metrics = False, profile_slowest = 0):
+    """
+    Returns the Flask app of the service, serving the timings of src/instrumentation.py on /metrics if metrics is set.
+    """
+    app = Flask(__name__)
+    app.register_blueprint(distance_api)
+    if metrics:
+        instrumentation.enable()
+        instrumentation.install(app, profile_slowest)
+    return app
+
+
+def serve(app, host = '127.0.0.1', port = 8052, processes = None):
+    """
+    Serves app from processes workers forked after preloading, which all accept connections on the same
+    socket. Each worker keeps its own caches. With processes=1, or where fork is not available, the
+    requests are served by the current process.
+    """
+    server = make_server(host, port, app)
+    processes = processes or os.cpu_count() or 1
+    preload()
+    print(f'Serving on http://{host}:{server.port}/api with {processes} processes', file=sys.stderr)
+    if processes == 1 or not hasattr(os, 'fork'):
+        server.serve_forever()
+        return
+    workers = []
+    for _ in range(processes):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            server.serve_forever()
+            os._exit(0)
+        workers.append(pid)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for pid in workers:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        server.server_close()
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='HTTP/JSON tonality distance service.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8052)
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--tables', default=None, help='table file built by python -m src.distance_tables, mapped before forking the workers')
+    parser.add_argument('--metrics', action='store_true', default=instrumentation.enabled_by_environment(),
+                        help='serve per-process timings on /metrics (default: set by TONALITY_METRICS)')
+    parser.add_argument('--profile-slowest', type=int, default=int(os.environ.get('TONALITY_PROFILE_SLOWEST', 0)),
+                        help='with --metrics, keep the cProfile output of the N slowest requests on /metrics/profiles')
+    args = parser.parse_args(argv)
+    if args.tables:
+        use_distance_tables(args.tables)
+    serve(create_app(args.metrics, args.profile_slowest), args.host, args.port, args.processes)
@@ -0,0 +1,209 @@
+import argparse
+import json
+import math
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+
+from src.distance_cache import normalize_weight, normalize_weights
+from src.path_signatures import _graph_fingerprint
+from src.tonality_distance import ShortestPathTree, _numpy_tonality_distance, get_shortest_path_tree
+
+
+MAGIC = b'TONDIST\0'
+FORMAT_VERSION = 2
+WEIGHT_NAMES = ['neighbor', 'relative', 'parallel', 'enharmonic', 'dominant']
+DEFAULT_AXIS = (0.01, 1, 2, 5, 10, math.inf)
+
+# The file starts with the magic, the format version and the length of the JSON header that follows,
+# the arrays start after the header on 64 byte boundaries
+_prefix = struct.Struct('<8sII')
+_alignment = 64
+
+# Arrays of the ShortestPathTree of every weight setting stored with paths, with their dtype and shape
+_path_sections = {
+    'predecessor': ('<i2', (2, 168)),
+    'modulation': ('<i1', (2, 168)),
+    'dag': ('|b1', (2, 168, 7)),
+    'order': ('<i2', (2, 168)),
+    'hops': ('<i2', (2, 168)),
+}
+
+
+def _align(offset):
+    return -(-offset // _alignment) * _alignment
+
+
+def _grid_weights(axes, start, stop):
+    """
+    Returns the weights of the grid entries start to stop, the grid being the product of the axes in C order.
+    """
+    positions = np.unravel_index(np.arange(start, stop), [len(axis) for axis in axes])
+    return np.column_stack([np.asarray(axis)[position] for axis, position in zip(axes, positions)])
+
+
+def _compute_chunk(task):
+    axes, start, stop, paths = task
+    weights = _grid_weights(axes, start, stop)
+    tensors = np.stack([_numpy_tonality_distance(w) for w in weights])
+    if not paths:
+        return start, tensors, {}
+    trees = [get_shortest_path_tree(*w) for w in weights]
+    return start, tensors, {name: np.stack([getattr(tree, name) for tree in trees]) for name in _path_sections}
+
+
+def build_distance_tables(path, axes, paths = False, processes = None, chunk_size = 256):
+    """
+    Writes the 7x12x4 tonality distance tensors of every weight setting of a grid to path, along with the
+    arrays of their ShortestPathTree if paths is set, so that the shortest paths can be served from the file.
+
+    axes lists the values of each of the five weights, np.inf disabling the modulation type, and the grid
+    is their product. Tensors are computed by the numpy engine in a pool of processes and the file is
+    written next to path then moved in place, so workers mapping the previous file are not disturbed.
+    """
+    axes = [sorted(set(normalize_weight(value) for value in axis)) for axis in axes]
+    if len(axes) != 5 or not all(axes):
+        raise ValueError('The grid needs values for each of the 5 modulation weights')
+    if min(min(axis) for axis in axes) <= 0:
+        raise ValueError('Modulation weights must be positive')
+    count = math.prod(len(axis) for axis in axes)
+
+    sections = {'tonality_distance': ('<f8', (count, 7, 12, 4))}
+    if paths:
+        sections.update({name: (dtype, (count,) + shape) for name, (dtype, shape) in _path_sections.items()})
+    header = {'graph': _graph_fingerprint(), 'axes': [[None if math.isinf(value) else value for value in axis] for axis in axes],
+              'count': count, 'sections': {}}
+    # The offsets of the arrays depend on the length of the header, which depends on the offsets:
+    # start after the header without sections and move the arrays further until the header fits
+    start = _align(_prefix.size + len(json.dumps(header)))
+    while True:
+        offset = start
+        for name, (dtype, shape) in sections.items():
+            header['sections'][name] = {'offset': offset, 'dtype': dtype, 'shape': shape}
+            offset = _align(offset + np.dtype(dtype).itemsize * math.prod(shape))
+        header_bytes = json.dumps(header).encode()
+        if _prefix.size + len(header_bytes) <= start:
+            break
+        start = _align(_prefix.size + len(header_bytes))
+
+    # Readers of the tables, such as the distance service, never build them and do not import multiprocessing
+    from multiprocessing import Pool
+
+    temporary_path = f'{path}.tmp'
+    with open(temporary_path, 'wb') as file:
+        file.write(_prefix.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+        file.write(header_bytes)
+        file.truncate(offset)
+    arrays = {name: np.memmap(temporary_path, section['dtype'], 'r+', section['offset'], tuple(section['shape']))
+              for name, section in header['sections'].items()}
+    tasks = [(axes, start, min(start + chunk_size, count), paths) for start in range(0, count, chunk_size)]
+    with Pool(processes) as pool:
+        for start, tensors, trees in pool.imap_unordered(_compute_chunk, tasks):
+            arrays['tonality_distance'][start:start + len(tensors)] = tensors
+            for name, values in trees.items():
+                arrays[name][start:start + len(tensors)] = values
+    for array in arrays.values():
+        array.flush()
+    del arrays
+    os.replace(temporary_path, path)
+
+
+class DistanceTables:
+    """
+    Read-only, memory-mapped view of a file written by build_distance_tables.
+
+    The arrays are mapped rather than read, so worker processes share the pages of one copy and only load
+    the pages they touch, and the tensors of weights on the grid are returned as views of the mapping, as are
+    the arrays of their shortest path trees when the file was built with paths.
+    Other weights fall back to the numpy engine.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            magic, version, header_length = _prefix.unpack(file.read(_prefix.size))
+            if magic != MAGIC:
+                raise ValueError(f'{path} is not a tonality distance table file')
+            if version != FORMAT_VERSION:
+                raise ValueError(f'{path} has format version {version}, expected {FORMAT_VERSION}: rebuild it with python -m src.distance_tables')
+            header = json.loads(file.read(header_length))
+        if header['graph'] != _graph_fingerprint():
+            raise ValueError(f'{path} was built for another definition of the graph: rebuild it with python -m src.distance_tables')
+        self.path = path
+        self.axes = [tuple(math.inf if value is None else value for value in axis) for axis in header['axes']]
+        self._positions = [{value: i for i, value in enumerate(axis)} for axis in self.axes]
+        self._strides = np.cumprod([1] + [len(axis) for axis in self.axes[:0:-1]])[::-1].tolist()
+        arrays = {name: np.memmap(path, section['dtype'], 'r', section['offset'], tuple(section['shape'])).view(np.ndarray)
+                  for name, section in header['sections'].items()}
+        self.tensors = arrays['tonality_distance']
+        self.trees = {name: arrays[name] for name in _path_sections} if 'predecessor' in arrays else None
+
+    def __len__(self):
+        return len(self.tensors)
+
+    def index(self, neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight):
+        """
+        Returns the index of the weights in the grid, None if they are not on the grid.
+        """
+        weights = normalize_weights(neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight)
+        index = 0
+        for weight, positions, stride in zip(weights, self._positions, self._strides):
+            position = positions.get(weight)
+            if position is None:
+                return None
+            index += position * stride
+        return index
+
+    def lookup(self, neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight):
+        """
+        Returns the read-only 7x12x4 tensor of weights on the grid without copying it, None for other weights.
+        """
+        index = self.index(neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight)
+        return None if index is None else self.tensors[index]
+
+    def tonality_distance(self, neighbor_weight = 1,
+                          relative_weight = 0.7,
+                          parallel_weight = 1.3,
+                          enharmonic_weight = 0.5,
+                          dominant_weight = 1.2):
+        """
+        Returns the 7x12x4 tensor of get_tonality_distance, from the tables or from the numpy engine.
+        """
+        tonality_distance = self.lookup(neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight)
+        if tonality_distance is None:
+            tonality_distance = _numpy_tonality_distance((neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight))
+        return tonality_distance
+
+    def shortest_path_tree(self, neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight):
+        """
+        Returns the ShortestPathTree of get_shortest_path_tree for weights on the grid, its arrays being views of
+        the mapping, None if the weights are not on the grid or the file was built without paths.
+        """
+        weights = normalize_weights(neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight)
+        index = self.index(*weights)
+        if index is None or self.trees is None:
+            return None
+        return ShortestPathTree(self.tensors[index], weights=weights, **{name: array[index] for name, array in self.trees.items()})
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Precomputes the tonality distance tensors of a grid of weights (python -m src.distance_tables).')
+    parser.add_argument('output', help='table file to write')
+    for name in WEIGHT_NAMES:
+        parser.add_argument(f'--{name}', nargs='+', type=float, default=DEFAULT_AXIS, metavar='WEIGHT',
+                            help=f'{name} weights of the grid, inf disables the modulation type (default: {" ".join(map(str, DEFAULT_AXIS))})')
+    parser.add_argument('--paths', action='store_true', help='also store the shortest path trees, so the distance service serves /api/path from the file')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes (default: all cores)')
+    args = parser.parse_args(argv)
+
+    axes = [getattr(args, name) for name in WEIGHT_NAMES]
+    start = time.perf_counter()
+    build_distance_tables(args.output, axes, args.paths, args.processes)
+    tables = DistanceTables(args.output)
+    print(f'{len(tables)} weight settings written to {args.output} ({os.path.getsize(args.output) / 2**20:.1f} MiB) '
+          f'in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
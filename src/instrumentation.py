@@ -0,0 +1,268 @@
+import bisect
+import functools
+import heapq
+import io
+import itertools
+import os
+import re
+import threading
+import time
+
+from flask import Response, g, request
+
+
+# Upper bounds in seconds of the histogram buckets, from 10us to 10s
+BUCKETS = tuple(scale * 10.0 ** exponent for exponent in range(-5, 1) for scale in (1, 2.5, 5)) + (10.0,)
+
+enabled = False
+
+
+def enabled_by_environment():
+    """
+    True if the TONALITY_METRICS environment variable asks for instrumentation.
+    TONALITY_PROFILE_SLOWEST=N additionally keeps the cProfile output of the N slowest requests.
+    """
+    return os.environ.get('TONALITY_METRICS', '') not in ('', '0')
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        bucket = bisect.bisect_left(BUCKETS, value)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Metrics:
+    """
+    Histograms and counters of this process, keyed on their name and labels.
+    Processes of a worker pool each keep their own metrics.
+    """
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.help = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def increment(self, name, value = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+
+metrics = Metrics()
+metrics.help = {
+    'tonality_stage_seconds': 'Time spent in each stage of the distance engine and of the callbacks',
+    'tonality_request_seconds': 'Time spent serving each kind of request',
+    'tonality_paths_enumerated_total': 'Shortest paths enumerated one by one',
+    'tonality_cache_hits_total': 'Entries served from the default cache, by kind (tensor, tree or nearest keys index)',
+    'tonality_cache_misses_total': 'Entries computed by the default cache, by kind (tensor, tree or nearest keys index)',
+    'tonality_cache_size': 'Entries held by the default cache, by kind (tensor, tree or nearest keys index)',
+}
+
+
+def _escape_label(value):
+    # The exposition format escapes backslashes, double quotes and line feeds in label values
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in labels) + '}'
+
+
+def render_metrics():
+    """
+    Returns the metrics in the Prometheus text exposition format.
+    """
+    from src.distance_cache import default_cache
+
+    lines = []
+    with metrics._lock:
+        histograms = sorted(metrics.histograms.items())
+        counters = sorted(metrics.counters.items())
+    for name, group in itertools.groupby(histograms, key=lambda item: item[0][0]):
+        lines += [f'# HELP {name} {metrics.help.get(name, name)}', f'# TYPE {name} histogram']
+        for (_, labels), histogram in group:
+            with histogram._lock:
+                counts, total, count = list(histogram.counts), histogram.sum, histogram.count
+            cumulative = itertools.accumulate(counts)
+            for bound, bucket_count in zip(BUCKETS + ('+Inf',), cumulative):
+                lines.append(f'{name}_bucket{_format_labels(labels, le=bound)} {bucket_count}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {total!r}')
+            lines.append(f'{name}_count{_format_labels(labels)} {count}')
+    for name, group in itertools.groupby(counters, key=lambda item: item[0][0]):
+        lines += [f'# HELP {name} {metrics.help.get(name, name)}', f'# TYPE {name} counter']
+        lines += [f'{name}{_format_labels(labels)} {value}' for (_, labels), value in group]
+    # The cache already counts its hits and misses, they are read at scrape time
+    kinds = default_cache.info()['kinds']
+    for name, metric_type, field in (('tonality_cache_hits_total', 'counter', 'hits'),
+                                     ('tonality_cache_misses_total', 'counter', 'misses'),
+                                     ('tonality_cache_size', 'gauge', 'size')):
+        lines += [f'# HELP {name} {metrics.help[name]}', f'# TYPE {name} {metric_type}']
+        lines += [f'{name}{_format_labels((), kind=kind)} {counts[field]}' for kind, counts in kinds.items()]
+    return '\n'.join(lines) + '\n'
+
+
+def instrument(owner, attribute, stage, counter = None):
+    """
+    Replaces the function owner.attribute (of a module or a class) by a wrapper recording its duration in
+    the tonality_stage_seconds histogram, and counting its calls in the counter metric if given. Only calls
+    that look the function up on owner are timed, such as calls from within its module, so the stages are
+    functions called through their module globals.
+    """
+    function = getattr(owner, attribute)
+    if getattr(function, '_instrumented', False):
+        return
+    histogram = metrics.histogram('tonality_stage_seconds', stage=stage)
+
+    @functools.wraps(function)
+    def timed(*args, **kwargs):
+        if counter is not None:
+            metrics.increment(counter)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+    timed._instrumented = True
+    setattr(owner, attribute, timed)
+
+
+def enable():
+    """
+    Instruments the stages of the distance engine and the serialization of the Dash responses.
+    Nothing is instrumented until this is called, so the code runs unchanged when instrumentation is off.
+    """
+    global enabled
+    import dash._callback
+    from src import distance_cache, tonality_distance
+    from src.tonality_distance import ShortestPathTree
+
+    enabled = True
+    instrument(tonality_distance, '_build_keys_graph', 'graph_build')
+    instrument(tonality_distance, '_dijkstra_tonality_distance', 'dijkstra')
+    instrument(tonality_distance, '_relax_distance', 'relax')
+    # _relax also runs within _relax_distance, so the incremental updates are timed as a whole. The cache
+    # calls update_shortest_path_tree through its own module globals
+    instrument(tonality_distance, 'update_shortest_path_tree', 'update_shortest_path_tree')
+    instrument(distance_cache, 'update_shortest_path_tree', 'update_shortest_path_tree')
+    instrument(tonality_distance, '_shortest_path_tree', 'shortest_path_tree')
+    instrument(ShortestPathTree, '_counts', 'count_paths')
+    # Every path enumeration goes through kth_path_with_modulations, so each path served counts once
+    instrument(ShortestPathTree, 'kth_path_with_modulations', 'kth_path', counter='tonality_paths_enumerated_total')
+    # Dash serializes the callback outputs with to_json looked up in dash._callback
+    if hasattr(dash._callback, 'to_json'):
+        instrument(dash._callback, 'to_json', 'serialization')
+
+
+class SlowestProfiles:
+    """
+    Keeps the cProfile statistics of the n slowest requests.
+    """
+    def __init__(self, n):
+        self.n = n
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def add(self, duration, description, profiler):
+        with self._lock:
+            if len(self._heap) >= self.n and duration <= self._heap[0][0]:
+                return
+        import pstats
+
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(30)
+        entry = (duration, next(self._counter), description, stream.getvalue())
+        with self._lock:
+            if len(self._heap) < self.n:
+                heapq.heappush(self._heap, entry)
+            elif duration > self._heap[0][0]:
+                heapq.heapreplace(self._heap, entry)
+
+    def render(self):
+        with self._lock:
+            entries = sorted(self._heap, reverse=True)
+        return ''.join(f'=== {duration * 1000:.1f} ms {description}\n{stats}\n' for duration, _, description, stats in entries)
+
+
+def _request_kind(dash_app):
+    # Requests are labelled with their route rather than their path, so that arbitrary paths cannot create
+    # new histograms, and requests matching no route share the unmatched label.
+    # Dash callbacks all go through one route, they are told apart by their outputs, without the hashes
+    # that Dash appends to duplicate outputs. Outputs of no registered callback are unmatched as well.
+    rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    if request.path.endswith('_dash-update-component'):
+        payload = request.get_json(silent=True)
+        output = payload.get('output') if isinstance(payload, dict) else None
+        if dash_app is None or not isinstance(output, str) or output not in dash_app.callback_map:
+            return rule, 'unmatched'
+        return rule, re.sub(r'@[0-9a-f]+', '', output)
+    return rule, ''
+
+
+def install(server, profile_slowest = 0, dash_app = None):
+    """
+    Times the requests of a Flask server in the tonality_request_seconds histogram and serves the metrics
+    on /metrics, and the profiles of the profile_slowest slowest requests on /metrics/profiles.
+    Profiling slows every request down, it is meant for short investigations.
+    dash_app is the Dash app served by server, if any, whose callbacks label the callback requests.
+    """
+    import cProfile
+
+    profiles = SlowestProfiles(profile_slowest) if profile_slowest else None
+
+    @server.before_request
+    def _start_timer():
+        if request.path.startswith('/metrics'):
+            return
+        g.tonality_start = time.perf_counter()
+        if profiles is not None:
+            g.tonality_profiler = cProfile.Profile()
+            g.tonality_profiler.enable()
+
+    @server.after_request
+    def _record_request(response):
+        start = g.pop('tonality_start', None)
+        if start is None:
+            return response
+        profiler = g.pop('tonality_profiler', None)
+        if profiler is not None:
+            profiler.disable()
+        duration = time.perf_counter() - start
+        path, output = _request_kind(dash_app)
+        metrics.histogram('tonality_request_seconds', path=path, output=output).observe(duration)
+        if profiler is not None:
+            profiles.add(duration, f'{request.method} {request.full_path} {output}', profiler)
+        return response
+
+    @server.route('/metrics')
+    def _metrics():
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+    @server.route('/metrics/profiles')
+    def _profiles():
+        return Response(profiles.render() if profiles else 'Profiling is off, set TONALITY_PROFILE_SLOWEST=N\n', mimetype='text/plain')
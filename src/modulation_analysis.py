@@ -0,0 +1,182 @@
+import argparse
+import csv
+import itertools
+import json
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+from src.batch_distance import encode_keys, key_distance_matrix
+from src.music_theory import KeyNameError, parse_keys
+from src.tonality_distance import DEFAULT_WEIGHTS, MODES, get_shortest_path_tree
+
+
+OUTPUT_COLUMNS = ['piece', 'position', 'key_from', 'key_to', 'distance', 'cumulative_distance', 'modulation']
+
+
+def read_csv_pieces(path, piece_column = 'piece', key_column = 'key'):
+    """
+    Yields (piece, keys) from a CSV file with one local key per row.
+    Rows of a piece must be contiguous; the file is read line by line.
+    """
+    with open(path, newline='') as file:
+        rows = csv.DictReader(file)
+        for piece, piece_rows in itertools.groupby(rows, key=lambda row: row[piece_column]):
+            yield piece, [row[key_column] for row in piece_rows]
+
+
+def read_jsonl_pieces(path, piece_field = 'piece', keys_field = 'keys'):
+    """
+    Yields (piece, keys) from a JSONL file with one piece and its list of local keys per line.
+    """
+    with open(path) as file:
+        for line_number, line in enumerate(file):
+            if line.strip():
+                record = json.loads(line)
+                yield record.get(piece_field, line_number), record[keys_field]
+
+
+def read_pieces(path, piece_field = 'piece', keys_field = None):
+    """
+    Yields (piece, keys) from a .csv or .jsonl key-sequence file.
+    """
+    if path.endswith('.csv'):
+        return read_csv_pieces(path, piece_field, keys_field or 'key')
+    if path.endswith('.jsonl'):
+        return read_jsonl_pieces(path, piece_field, keys_field or 'keys')
+    raise ValueError(f'Unsupported input format: {path}')
+
+
+class ModulationAnalyzer:
+    """
+    Step-by-step and cumulative modulation distances of key sequences for one weight setting.
+    The modulation of a transition lists the graph edges of its shortest path, e.g. 'Relative minor > Parallel',
+    and is empty for transitions only reachable through disabled modulation types.
+    """
+    def __init__(self, weights):
+        self.tree = get_shortest_path_tree(*weights)
+        self.distance_matrix = key_distance_matrix(self.tree.tonality_distance)
+        # The shortest path only depends on the interval and the modes, so the modulations are laid out
+        # like the distance tensor and expanded to every pair of keys the same way
+        modulations = np.empty((7, 12, 4), dtype=object)
+        for dia in range(7):
+            for chro in range(12):
+                for transition, (mode_from, mode_to) in enumerate(itertools.product(MODES, MODES)):
+                    if np.isinf(self.tree.tonality_distance[dia, chro, transition]):
+                        modulations[dia, chro, transition] = ''
+                    else:
+                        modulations[dia, chro, transition] = ' > '.join(self.tree.path_modulations((0, 0, mode_from), (dia, chro, mode_to)))
+        self.modulation_matrix = key_distance_matrix(modulations)
+
+    def analyze(self, piece, keys):
+        """
+        Returns a dict with the transitions of the piece, or with an 'error' entry if some keys are invalid.
+        """
+        try:
+            packed = encode_keys(parse_keys(keys))
+        except KeyNameError as error:
+            return {'piece': piece, 'error': str(error)}
+        distances = self.distance_matrix[packed[:-1], packed[1:]]
+        return {
+            'piece': piece,
+            'keys': list(keys),
+            'distances': distances.tolist(),
+            'cumulative_distances': np.cumsum(distances).tolist(),
+            'modulations': self.modulation_matrix[packed[:-1], packed[1:]].tolist(),
+        }
+
+
+_worker_analyzer = None
+
+
+def _init_worker(weights):
+    global _worker_analyzer
+    _worker_analyzer = ModulationAnalyzer(weights)
+
+
+def _analyze_in_worker(piece_keys):
+    return _worker_analyzer.analyze(*piece_keys)
+
+
+def analyze_pieces(pieces, weights, processes = None, batch_size = 1024):
+    """
+    Yields the analysis of every (piece, keys) in order.
+    Pieces are dispatched to a process pool batch_size at a time, so at most one batch is held in memory.
+    With processes=1 the analysis runs in the current process.
+    """
+    if processes == 1:
+        analyzer = ModulationAnalyzer(weights)
+        for piece, keys in pieces:
+            yield analyzer.analyze(piece, keys)
+        return
+    # Analyses in the current process, and importers of ModulationAnalyzer, do not import multiprocessing
+    from multiprocessing import Pool
+
+    pieces = iter(pieces)
+    chunksize = max(1, batch_size // (4 * (processes or os.cpu_count() or 1)))
+    with Pool(processes, initializer=_init_worker, initargs=(weights,)) as pool:
+        while True:
+            batch = list(itertools.islice(pieces, batch_size))
+            if not batch:
+                break
+            yield from pool.imap(_analyze_in_worker, batch, chunksize=chunksize)
+
+
+class CsvWriter:
+    def __init__(self, file):
+        self.writer = csv.writer(file)
+        self.writer.writerow(OUTPUT_COLUMNS)
+
+    def write(self, result):
+        keys = result['keys']
+        for position, (distance, cumulative, modulation) in enumerate(zip(result['distances'], result['cumulative_distances'], result['modulations'])):
+            self.writer.writerow([result['piece'], position, keys[position], keys[position + 1], distance, cumulative, modulation])
+
+
+class JsonlWriter:
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, result):
+        # JSON has no infinity: transitions only reachable through disabled modulation types get null
+        for field in ('distances', 'cumulative_distances'):
+            if field in result:
+                result = dict(result, **{field: [value if math.isfinite(value) else None for value in result[field]]})
+        self.file.write(json.dumps(result, allow_nan=False) + '\n')
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Step-by-step and cumulative modulation distances of key sequences.')
+    parser.add_argument('input', help='.csv file (one key per row) or .jsonl file (one piece per line)')
+    parser.add_argument('output', help='.csv or .jsonl output file, - for CSV on stdout')
+    parser.add_argument('--weights', nargs=5, type=float, default=list(DEFAULT_WEIGHTS),
+                        metavar=('NEIGHBOR', 'RELATIVE', 'PARALLEL', 'ENHARMONIC', 'DOMINANT'),
+                        help='modulation weights, inf disables a modulation type')
+    parser.add_argument('--piece-field', default='piece', help='piece column (CSV) or field (JSONL)')
+    parser.add_argument('--keys-field', default=None, help='key column (CSV, default key) or key list field (JSONL, default keys)')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--batch-size', type=int, default=1024, help='number of pieces in flight at once')
+    args = parser.parse_args(argv)
+
+    pieces = read_pieces(args.input, args.piece_field, args.keys_field)
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', newline='')
+    writer = JsonlWriter(output) if args.output.endswith('.jsonl') else CsvWriter(output)
+    start = time.perf_counter()
+    n_pieces = 0
+    n_errors = 0
+    try:
+        for result in analyze_pieces(pieces, tuple(args.weights), args.processes, args.batch_size):
+            n_pieces += 1
+            if 'error' in result:
+                n_errors += 1
+                print(f'Skipping piece {result["piece"]}: {result["error"]}', file=sys.stderr)
+                continue
+            writer.write(result)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.perf_counter() - start
+    print(f'{n_pieces} pieces ({n_errors} skipped) in {elapsed:.2f}s: {n_pieces / elapsed:.1f} pieces/s', file=sys.stderr)
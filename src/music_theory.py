@@ -1,52 +1,198 @@
+import functools
+
+import numpy as np
+
+
 class Pitch:
+    """
+    Pitches are flyweights: Pitch(name), Pitch.from_dia_chro and Pitch.__add__ return shared instances
+    looked up in tables precomputed for the 84 (diatonic, chromatic) spellings, so they cannot be modified.
+    Pitch(name) returns the pitch of the (diatonic, chromatic) spelling of the name, octave digits being
+    ignored and 'b' being spelled '-': Pitch('Eb4') is Pitch('E-').
+    """
+    __slots__ = ('name', 'name_without_accidental', 'accidental', 'diatonic', 'chromatic', 'packed', '_hash')
     note_names = ['C', 'D', 'E', 'F', 'G', 'A', 'B']
     diatonic_dict = {note: i for i, note in enumerate(note_names)}
     chromatic_dict = {'C':0, 'D':2, 'E':4, 'F':5, 'G':7, 'A':9, 'B':11}
-    def __init__(self, name:str):
+    # The 84 flyweights by their own name, filled once below
+    _by_name = {}
+    _by_dia_chro = []
+
+    def __new__(cls, name:str):
+        pitch = cls._by_name.get(name)
+        if pitch is None:
+            pitch = cls._by_dia_chro[cls._parse(name)]
+        return pitch
+
+    @classmethod
+    def _parse(cls, name):
+        """
+        Returns the packed diatonic * 12 + chromatic index of a pitch name.
+        """
         name = ''.join([x for x in name if not x.isdigit()])
-        self.name = name
-        self.name_without_accidental = name[0]
-        self.accidental = name[1:].replace('b','-')
-        assert self.name_without_accidental in self.diatonic_dict, f'Invalid note name: {name}'
-        assert all(['#' == x for x in  self.accidental]) or all(['-' == x for x in  self.accidental]) , f'Invalid accidental: {self.accidental}'
-        self.diatonic = self.diatonic_dict[self.name_without_accidental]
-        self.chromatic = (self.chromatic_dict[self.name_without_accidental] + sum(x=='#' for x in self.accidental) - sum(x=='-' for x in self.accidental) )%12
+        name_without_accidental = name[0]
+        accidental = name[1:].replace('b','-')
+        assert name_without_accidental in cls.diatonic_dict, f'Invalid note name: {name}'
+        assert all(['#' == x for x in  accidental]) or all(['-' == x for x in  accidental]) , f'Invalid accidental: {accidental}'
+        diatonic = cls.diatonic_dict[name_without_accidental]
+        chromatic = (cls.chromatic_dict[name_without_accidental] + sum(x=='#' for x in accidental) - sum(x=='-' for x in accidental) )%12
+        return diatonic * 12 + chromatic
+
+    @classmethod
+    def _create(cls, diatonic, chromatic):
+        pitch = object.__new__(cls)
+        name = _spelling(diatonic, chromatic)
+        for attribute, value in (('name', name), ('name_without_accidental', name[0]), ('accidental', name[1:]),
+                                 ('diatonic', diatonic), ('chromatic', chromatic), ('packed', diatonic * 12 + chromatic),
+                                 ('_hash', hash((diatonic, chromatic)))):
+            object.__setattr__(pitch, attribute, value)
+        return pitch
+
+    def __setattr__(self, attribute, value):
+        raise AttributeError(f'Pitches are shared flyweights, {attribute} cannot be set')
 
     def __repr__(self):
         return f'{self.name}'
 
+    def __reduce__(self):
+        return (Pitch, (self.name,))
+
     def __eq__(self, other):
         return self.chromatic == other.chromatic and self.diatonic == other.diatonic
 
     def __add__(self, interval):
-        diatonic = (self.diatonic + interval.diatonic)%7
-        chromatic = (self.chromatic + interval.chromatic)%12
-        return Pitch.from_dia_chro(diatonic, chromatic)
+        return self._by_dia_chro[(self.diatonic + interval.diatonic)%7 * 12 + (self.chromatic + interval.chromatic)%12]
 
     @classmethod
     def from_dia_chro(cls, diatonic, chromatic):
-        diatonic %= 7
-        chromatic %= 12
-        name_without_accidental = cls.note_names[diatonic]
-        accidental_number = (chromatic - cls.chromatic_dict[name_without_accidental])%12
-        accidental =  '#' * (accidental_number <=6)*accidental_number  + '-' * (accidental_number > 6) *(12-accidental_number)
-        return Pitch(name_without_accidental + accidental)
+        return cls._by_dia_chro[diatonic % 7 * 12 + chromatic % 12]
+
+    @classmethod
+    def from_packed(cls, packed):
+        """
+        Returns the pitch of a packed diatonic * 12 + chromatic index, see Pitch.packed.
+        """
+        return cls._by_dia_chro[packed]
+
+    def key_index(self, mode):
+        """
+        Returns the packed index of the key on this pitch, as used by the distance code:
+        (diatonic * 12 + chromatic) * 2 + mode, mode being 'M' (0) or 'm' (1).
+        """
+        return self.packed * 2 + (mode == 'm')
 
     def __hash__(self):
-        return hash((self.diatonic, self.chromatic))
+        return self._hash
+
+
+def _spelling(diatonic, chromatic):
+    name_without_accidental = Pitch.note_names[diatonic]
+    accidental_number = (chromatic - Pitch.chromatic_dict[name_without_accidental])%12
+    accidental =  '#' * (accidental_number <=6)*accidental_number  + '-' * (accidental_number > 6) *(12-accidental_number)
+    return name_without_accidental + accidental
+
+
+Pitch._by_dia_chro = [Pitch._create(diatonic, chromatic) for diatonic in range(7) for chromatic in range(12)]
+Pitch._by_name = {pitch.name: pitch for pitch in Pitch._by_dia_chro}
 
 
 class Interval:
-    def __init__(self, pitchStart:Pitch, pitchEnd:Pitch ):
-        self.diatonic = (pitchEnd.diatonic - pitchStart.diatonic)%7
-        self.chromatic = (pitchEnd.chromatic - pitchStart.chromatic)%12
-        self.interval_number = self.diatonic + 1
+    """
+    Intervals are flyweights shared through a table of the 84 (diatonic, chromatic) intervals, so they cannot
+    be modified.
+    """
+    __slots__ = ('diatonic', 'chromatic', 'interval_number', '_hash')
+    _by_dia_chro = []
+
+    def __new__(cls, pitchStart:Pitch, pitchEnd:Pitch ):
+        return cls._by_dia_chro[(pitchEnd.diatonic - pitchStart.diatonic)%7 * 12 + (pitchEnd.chromatic - pitchStart.chromatic)%12]
+
+    @classmethod
+    def _create(cls, diatonic, chromatic):
+        interval = object.__new__(cls)
+        for attribute, value in (('diatonic', diatonic), ('chromatic', chromatic), ('interval_number', diatonic + 1),
+                                 ('_hash', hash((diatonic, chromatic)))):
+            object.__setattr__(interval, attribute, value)
+        return interval
+
+    def __setattr__(self, attribute, value):
+        raise AttributeError(f'Intervals are shared flyweights, {attribute} cannot be set')
 
     def __repr__(self):
         return f'({self.diatonic}, {self.chromatic})'
 
+    def __reduce__(self):
+        return (Interval, (Pitch.from_packed(0), Pitch.from_dia_chro(self.diatonic, self.chromatic)))
+
     def __eq__(self, other):
         return self.diatonic == other.diatonic and self.chromatic == other.chromatic
 
     def __hash__(self):
-        return hash((self.diatonic, self.chromatic))
+        return self._hash
+
+
+Interval._by_dia_chro = [Interval._create(diatonic, chromatic) for diatonic in range(7) for chromatic in range(12)]
+
+
+class KeyNameError(ValueError):
+    """
+    Raised by parse_keys when some labels are not valid key names.
+    rows maps the index of every invalid label to the reason it was rejected.
+    """
+    def __init__(self, rows, labels):
+        self.rows = rows
+        shown = [f'row {row}: {str(labels[row])!r} ({reason})' for row, reason in list(rows.items())[:10]]
+        more = f' and {len(rows) - 10} more' if len(rows) > 10 else ''
+        super().__init__(f'{len(rows)} invalid key names: ' + ', '.join(shown) + more)
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_key(label):
+    """
+    Returns (diatonic, chromatic, mode) for a key label, or the reason why the label is invalid.
+    Labels are memoized in a bounded cache, as they may come from clients of the distance service.
+    """
+    name = label.strip()
+    if not name:
+        parsed = 'empty key name'
+    elif name[0].upper() not in Pitch.diatonic_dict:
+        parsed = f'invalid note name {name[0]!r}'
+    else:
+        accidental = name[1:].replace('b', '-')
+        if accidental.strip('#') and accidental.strip('-'):
+            parsed = f'invalid accidental {name[1:]!r}'
+        else:
+            note = name[0].upper()
+            chromatic = (Pitch.chromatic_dict[note] + accidental.count('#') - accidental.count('-')) % 12
+            parsed = (Pitch.diatonic_dict[note], chromatic, int(name[0].islower()))
+    return parsed
+
+
+def parse_keys(labels, errors = 'raise'):
+    """
+    Parses a sequence or numpy array of key labels such as 'F#', 'bb' or 'E-' (uppercase for major,
+    lowercase for minor, '-' or 'b' for flats) into three integer arrays (diatonic, chromatic, mode),
+    mode being 0 for major and 1 for minor, like the last index of the get_tonality_distance tensor.
+
+    Every distinct label is parsed once per call, and the 4096 most recently used labels are memoized across calls.
+    With errors='raise' invalid labels raise a KeyNameError listing the offending rows,
+    with errors='coerce' their rows are set to -1 in the three arrays.
+    """
+    if errors not in ('raise', 'coerce'):
+        raise ValueError(f'Invalid errors option: {errors}')
+    labels = np.asarray(labels, dtype=str)
+    unique_labels, inverse = np.unique(labels.ravel(), return_inverse=True)
+    table = np.full((3, len(unique_labels)), -1, dtype=np.intp)
+    invalid = {}
+    for i, label in enumerate(unique_labels.tolist()):
+        parsed = _parse_key(label)
+        if isinstance(parsed, str):
+            invalid[i] = parsed
+        else:
+            table[:, i] = parsed
+    if invalid and errors == 'raise':
+        flat_labels = labels.ravel()
+        rows = {int(row): invalid[index] for row, index in enumerate(inverse.tolist()) if index in invalid}
+        raise KeyNameError(rows, flat_labels)
+    diatonic, chromatic, mode = table[:, inverse].reshape((3,) + labels.shape)
+    return diatonic, chromatic, mode
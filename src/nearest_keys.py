@@ -0,0 +1,130 @@
+import numpy as np
+
+from src.batch_distance import encode_keys
+from src.music_theory import KeyNameError, Pitch, _parse_key
+from src.tonality_distance import MODES, _from_tensor, index_key, key_index
+
+
+# Name of every packed key index, uppercase for major and lowercase for minor keys
+KEY_NAMES = np.array([name for pitch in Pitch._by_dia_chro for name in (pitch.name, pitch.name.lower())])
+
+# Distances within this tolerance of the radius count as within the radius, as sums of weights such as
+# 0.7 + 1.3 are not exactly 2.0 in floating point
+RADIUS_TOLERANCE = 1e-9
+
+# _transposition[key, interval] is the packed index of key transposed by the interval from C or c to the
+# packed key interval, the mode being the one of interval
+_dia, _chro, _mode = np.unravel_index(np.arange(168), (7, 12, 2))
+_transposition = ((_dia[:, None] + _dia) % 7 * 12 + (_chro[:, None] + _chro) % 12) * 2 + _mode
+
+
+def _source_index(key):
+    """
+    Returns the packed index of a key given by name, as a (dia, chro, mode) tuple or as a packed index.
+    """
+    if isinstance(key, str):
+        parsed = _parse_key(key)
+        if isinstance(parsed, str):
+            raise KeyNameError({0: parsed}, [key])
+        return key_index(parsed[0], parsed[1], MODES[parsed[2]])
+    if isinstance(key, tuple):
+        return key_index(*key)
+    return int(encode_keys(int(key)))
+
+
+class NearestKeysIndex:
+    """
+    Keys sorted by their tonality distance from every key, for one weight setting.
+
+    The graph is invariant under transposition, so the keys are only sorted once from C and once from c,
+    and the neighbors of every other key are these lists transposed, precomputed for the 168 keys.
+    k-nearest queries then slice the first k neighbors and radius queries binary search the distances,
+    without sorting anything. A key is not its own neighbor, and keys at equal distance are ordered by
+    their interval from the source key. Keys only reachable through disabled modulation types are left out.
+
+    tree is the ShortestPathTree of the weights, whose paths give the modulations reaching every neighbor.
+    """
+    def __init__(self, tree):
+        self.tree = tree
+        self.weights = tree.weights
+        distance = _from_tensor(tree.tonality_distance).reshape(2, 168)
+        order = np.argsort(distance, axis=1, kind='stable')
+        # order[source mode] lists intervals from C and c, the first one being the source itself
+        order = order[order != np.arange(2)[:, None]].reshape(2, 167)
+        self.distance = np.take_along_axis(distance, order, axis=1)
+        self.reachable = np.isfinite(self.distance).sum(axis=1)
+        self._order = order
+
+        # neighbors[key] lists the packed indices of the other keys by increasing distance from key
+        self.neighbors = np.take_along_axis(_transposition, order[_mode], axis=1)
+        self.neighbors.flags.writeable = False
+        self.distance.flags.writeable = False
+        self._modulations = [[None] * 167, [None] * 167]
+
+    def _modulations_at(self, source_mode, rank):
+        modulations = self._modulations[source_mode][rank]
+        if modulations is None:
+            start = (0, 0, MODES[source_mode])
+            # Tuples, as the memoized labels are shared by every answer and every cached index
+            modulations = tuple(self.tree.path_modulations(start, index_key(self._order[source_mode, rank])))
+            self._modulations[source_mode][rank] = modulations
+        return modulations
+
+    def _neighbors(self, source, count):
+        source_mode = source % 2
+        neighbors = self.neighbors[source, :count]
+        return [(name, distance, self._modulations_at(source_mode, rank))
+                for rank, (name, distance) in enumerate(zip(KEY_NAMES[neighbors].tolist(), self.distance[source_mode, :count].tolist()))]
+
+    def nearest(self, key, k):
+        """
+        Returns the k keys closest to key as (name, distance, modulations) tuples by increasing distance,
+        modulations being a tuple of the labels of the modulations on a shortest path from key. Fewer keys
+        are returned when fewer are reachable.
+        """
+        source = _source_index(key)
+        return self._neighbors(source, min(max(k, 0), self.reachable[source % 2]))
+
+    def within(self, key, radius):
+        """
+        Returns the keys at distance at most radius from key, as nearest does.
+        """
+        source = _source_index(key)
+        return self._neighbors(source, self.count_within(source, radius))
+
+    def count_within(self, keys, radius):
+        """
+        Returns the number of keys at distance at most radius from each of keys, given in any form accepted
+        by encode_keys, or from a single packed key index. Missing keys have no neighbors.
+        """
+        counts = np.array([min(np.searchsorted(distance, radius + RADIUS_TOLERANCE, side='right'), reachable)
+                           for distance, reachable in zip(self.distance, self.reachable)] + [0])
+        sources = encode_keys(keys)
+        # Missing keys, encoded as -1, read the trailing 0
+        return counts[np.where(sources < 0, 2, sources % 2)]
+
+    def nearest_many(self, keys, k):
+        """
+        Vectorized nearest: returns the packed indices and the distances of the k keys closest to each of keys,
+        given in any form accepted by encode_keys, as two arrays of shape keys.shape + (k,). Entries past the
+        reachable keys and the neighbors of missing keys are -1 at distance np.inf. KEY_NAMES gives the names
+        of the other indices.
+        """
+        sources = encode_keys(keys)
+        k = min(max(k, 0), 167)
+        neighbors = self.neighbors[sources, :k]
+        distance = self.distance[sources % 2, :k]
+        distance[sources < 0] = np.inf
+        neighbors[np.isinf(distance)] = -1
+        return neighbors, distance
+
+    def within_many(self, keys, radius):
+        """
+        Vectorized within: returns the packed indices and the distances of the keys at distance at most
+        radius from each of keys as in nearest_many, the last dimension being the largest number of such keys.
+        """
+        counts = self.count_within(keys, radius)
+        neighbors, distance = self.nearest_many(keys, int(counts.max(initial=0)))
+        outside = np.arange(neighbors.shape[-1]) >= counts[..., None]
+        neighbors[outside] = -1
+        return neighbors, np.where(outside, np.inf, distance)
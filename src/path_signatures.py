@@ -0,0 +1,223 @@
+import warnings
+from pathlib import Path
+
+import numpy as np
+
+from src.tonality_distance import MODES, MODULATIONS, key_index
+
+
+SIGNATURES_PATH = Path(__file__).with_name('path_signatures.npz')
+
+
+def _graph_fingerprint():
+    # hashlib loads OpenSSL, which is slower to import than this module
+    import hashlib
+
+    return hashlib.sha256(repr(MODULATIONS).encode()).hexdigest()
+
+
+def _out_edges():
+    """
+    Returns two 168x7 arrays with the target key index and the weight index of the outgoing edges of every key.
+    """
+    out_target = [[] for _ in range(168)]
+    out_weight = [[] for _ in range(168)]
+    for dia in range(7):
+        for chro in range(12):
+            for source_mode, target_mode, dia_step, chro_step, weight_index, _ in MODULATIONS:
+                source = key_index(dia, chro, source_mode)
+                out_target[source].append(key_index(dia + dia_step, chro + chro_step, target_mode))
+                out_weight[source].append(weight_index)
+    return np.array(out_target), np.array(out_weight)
+
+
+def _pareto_signatures(source):
+    """
+    Returns, for every key, the signatures of the paths from source that are not dominated componentwise
+    by the signature of another path. Paths are expanded one edge at a time, so a signature can only be
+    dominated by signatures found at an earlier step or at the same step.
+    """
+    out_target, out_weight = _out_edges()
+    unit = np.eye(5, dtype=np.int64)
+    signatures = [np.zeros((0, 5), dtype=np.int64) for _ in range(168)]
+    signatures[source] = np.zeros((1, 5), dtype=np.int64)
+    frontier_key = np.array([source])
+    frontier_signature = np.zeros((1, 5), dtype=np.int64)
+    while len(frontier_key):
+        expanded = np.unique(np.column_stack([out_target[frontier_key].ravel(),
+                                              (frontier_signature[:, None, :] + unit[out_weight[frontier_key]]).reshape(-1, 5)]), axis=0)
+        keys, expanded = expanded[:, 0], expanded[:, 1:]
+        keep = np.ones(len(keys), dtype=bool)
+        bounds = np.searchsorted(keys, np.arange(169))
+        for key in np.unique(keys):
+            start, end = bounds[key], bounds[key + 1]
+            known = signatures[key]
+            keep[start:end] = ~(known[None, :, :] <= expanded[start:end, None, :]).all(axis=2).any(axis=1)
+            signatures[key] = np.concatenate([known, expanded[start:end][keep[start:end]]])
+        frontier_key, frontier_signature = keys[keep], expanded[keep]
+    return signatures
+
+
+def _packing_reaches_one(A, b):
+    """
+    Simplex on max sum(x) subject to A x <= b, x >= 0 with b > 0, stopped as soon as sum(x) reaches 1.
+    Bland's rule keeps it from cycling on degenerate pivots.
+    """
+    m, n = A.shape
+    tableau = np.zeros((m + 1, n + m + 1))
+    tableau[:m, :n] = A
+    tableau[:m, n:n + m] = np.eye(m)
+    tableau[:m, -1] = b
+    tableau[m, :n] = -1
+    while tableau[m, -1] < 1 - 1e-9:
+        entering = np.flatnonzero(tableau[m, :-1] < -1e-12)
+        if not len(entering):
+            return False
+        entering = entering[0]
+        column = tableau[:m, entering]
+        positive = column > 1e-12
+        if not positive.any():
+            return True
+        ratios = np.full(m, np.inf)
+        ratios[positive] = tableau[:m, -1][positive] / column[positive]
+        row = int(np.argmin(ratios))
+        tableau[row] /= tableau[row, entering]
+        others = np.arange(m + 1) != row
+        tableau[others] -= np.outer(tableau[others, entering], tableau[row])
+    return True
+
+
+def _is_redundant(signature, others):
+    """
+    True if signature is componentwise above a convex combination of others, in which case it never is
+    the only minimum for non-negative (or infinite) weights. Only signatures using no more modulation
+    types than signature can take part, so disabling a modulation type never needs a removed signature.
+    """
+    support = signature > 0
+    others = others[(others[:, ~support] == 0).all(axis=1)]
+    if not support.any() or not len(others):
+        return False
+    return _packing_reaches_one(others[:, support].T.astype(float), signature[support].astype(float))
+
+
+def _hull_signatures(signatures, rng):
+    """
+    Returns the signatures that are vertices of the lower convex hull. The minima for random weights are
+    vertices, so they are kept first and the other signatures are only checked against them and against
+    the signatures kept so far, which keeps the linear programs small.
+    """
+    weights = rng.uniform(0.01, 10, (512, 5))
+    disabled = rng.random((512, 5)) < 0.3
+    lengths = signatures @ np.where(disabled, 0, weights).T
+    lengths[(signatures > 0) @ disabled.T > 0] = np.inf
+    kept = np.zeros(len(signatures), dtype=bool)
+    kept[np.unique(lengths.argmin(axis=0))] = True
+    for i in np.argsort(signatures.sum(axis=1)):
+        if not kept[i] and not _is_redundant(signatures[i], signatures[kept]):
+            kept[i] = True
+    return signatures[kept]
+
+
+def enumerate_path_signatures():
+    """
+    Enumerates the lower hull signatures of every entry of the 7x12x4 tonality distance tensor.
+    Returns a Kx5 array of signatures grouped by tensor entry, in the order of the flattened tensor,
+    and the 337 offsets of the groups.
+    """
+    rng = np.random.default_rng(0)
+    groups = [None] * 336
+    for source_mode in range(2):
+        pareto = _pareto_signatures(key_index(0, 0, MODES[source_mode]))
+        for index, signatures in enumerate(pareto):
+            position, target_mode = divmod(index, 2)
+            groups[position * 4 + 2 * source_mode + target_mode] = _hull_signatures(signatures, rng)
+    offsets = np.concatenate([[0], np.cumsum([len(group) for group in groups])])
+    return np.concatenate(groups), offsets
+
+
+def save_path_signatures(path = SIGNATURES_PATH):
+    signatures, offsets = enumerate_path_signatures()
+    np.savez_compressed(path, signatures=signatures.astype(np.uint8), offsets=offsets, graph=_graph_fingerprint())
+
+
+def load_path_signatures(path = SIGNATURES_PATH):
+    """
+    Returns the signatures and offsets stored at path, or enumerates them again (which takes a while)
+    if the file is missing or was built for another definition of the graph.
+    The file shipped next to this module is rebuilt with `python -m src.path_signatures`.
+    """
+    try:
+        with np.load(path) as data:
+            if str(data['graph']) == _graph_fingerprint():
+                return data['signatures'].astype(float), data['offsets']
+    except OSError:
+        pass
+    warnings.warn(f'{path} is missing or outdated, enumerating path signatures (run python -m src.path_signatures to rebuild it)')
+    signatures, offsets = enumerate_path_signatures()
+    return signatures.astype(float), offsets
+
+
+class PathSignatureEngine:
+    """
+    Tonality distance tensors as a closed-form function of the five weights.
+
+    Every path is summarized by its signature, the number of edges of each modulation type it uses
+    (neighbor, relative, parallel, enharmonic, dominant), so its length is the dot product of the signature
+    with the weights and each distance is the minimum of these dot products over a set of signatures.
+    Only the vertices of the lower convex hull of the signatures can reach that minimum, and there are
+    a few thousand of them for the whole tensor: a batch of weight vectors costs one matrix product and a min.
+
+    The results equal get_tonality_distance up to floating-point rounding, since path lengths are summed
+    per modulation type instead of edge by edge. np.inf disables a modulation type as in get_tonality_distance.
+    """
+    def __init__(self, signatures = None, offsets = None):
+        if signatures is None:
+            signatures, offsets = load_path_signatures()
+        self.signatures = np.asarray(signatures, dtype=float)
+        self.offsets = np.asarray(offsets)
+        self._uses = (self.signatures > 0).astype(float)
+
+    def subset(self, entries):
+        """
+        Returns an engine restricted to some entries of the flattened 7x12x4 tensor, whose entry_distances
+        only computes these entries, in the given order.
+        """
+        groups = [self.signatures[self.offsets[entry]:self.offsets[entry + 1]] for entry in entries]
+        offsets = np.concatenate([[0], np.cumsum([len(group) for group in groups])])
+        return PathSignatureEngine(np.concatenate(groups), offsets)
+
+    def entry_distances(self, weights, chunk_size = 1024):
+        """
+        Returns the BxE distances of a Bx5 array of weight vectors, one column per tensor entry of the engine.
+        """
+        weights = np.atleast_2d(np.asarray(weights, dtype=float))
+        distances = np.empty((len(weights), len(self.offsets) - 1))
+        for start in range(0, len(weights), chunk_size):
+            chunk = weights[start:start + chunk_size]
+            disabled = np.isinf(chunk)
+            lengths = np.where(disabled, 0, chunk) @ self.signatures.T
+            if disabled.any():
+                lengths[disabled.astype(float) @ self._uses.T > 0] = np.inf
+            distances[start:start + chunk_size] = np.minimum.reduceat(lengths, self.offsets[:-1], axis=1)
+        return distances
+
+    def batch_tonality_distance(self, weights, chunk_size = 1024):
+        """
+        Returns the Bx7x12x4 distance tensors of a Bx5 array of weight vectors.
+        """
+        return self.entry_distances(weights, chunk_size).reshape(-1, 7, 12, 4)
+
+    def tonality_distance(self, neighbor_weight = 1,
+                          relative_weight = 0.7,
+                          parallel_weight = 1.3,
+                          enharmonic_weight = 0.5,
+                          dominant_weight = 1.2):
+        """
+        Returns the 7x12x4 tonality distance tensor for one set of weights.
+        """
+        weights = (neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight)
+        return self.batch_tonality_distance([weights])[0]
+
+
+if __name__ == '__main__':
+    save_path_signatures()
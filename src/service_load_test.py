@@ -0,0 +1,107 @@
+import argparse
+import http.client
+import json
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+from src.music_theory import Pitch
+
+
+KEY_NAMES = [name for pitch in Pitch._by_dia_chro if len(pitch.accidental) <= 1 for name in (pitch.name, pitch.name.lower())]
+
+
+def _weight_sets(count, rng):
+    """
+    Returns count weight query strings: the defaults first, then random slider values.
+    """
+    weight_sets = ['1,0.7,1.3,0.5,1.2']
+    while len(weight_sets) < count:
+        weight_sets.append(','.join(str(weight) for weight in rng.integers(1, 100, 5) / 10))
+    return weight_sets
+
+
+def _requests(endpoint, count, weight_sets, batch_size, rng):
+    """
+    Yields count (method, url, body) requests of an endpoint with random keys and weights.
+    """
+    for _ in range(count):
+        weights = weight_sets[rng.integers(len(weight_sets))]
+        if endpoint == 'distances':
+            body = {'from': rng.choice(KEY_NAMES, batch_size).tolist(), 'to': rng.choice(KEY_NAMES, batch_size).tolist(),
+                    'weights': [float(weight) for weight in weights.split(',')]}
+            yield 'POST', '/api/distances', json.dumps(body)
+        elif endpoint == 'tensor':
+            yield 'GET', '/api/tensor?' + urllib.parse.urlencode({'weights': weights}), None
+        else:
+            query = {'from': rng.choice(KEY_NAMES), 'to': rng.choice(KEY_NAMES), 'weights': weights}
+            yield 'GET', f'/api/{endpoint}?' + urllib.parse.urlencode(query), None
+
+
+def _run_client(host, port, requests, latencies, errors):
+    connection = http.client.HTTPConnection(host, port)
+    for method, url, body in requests:
+        start = time.perf_counter()
+        try:
+            connection.request(method, url, body, {'Content-Type': 'application/json'} if body else {})
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+            # The development server closes HTTP/1.0 connections after every response
+            if response.will_close:
+                connection.close()
+        except (OSError, http.client.HTTPException) as error:
+            errors.append(type(error).__name__)
+            connection.close()
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+
+
+def run_load_test(url, endpoint = 'distance', requests = 1000, concurrency = 8, weight_sets = 16,
+                  batch_size = 1000, seed = 0):
+    """
+    Sends requests to the endpoint of the service at url from concurrency client threads.
+    Returns the number of requests, the errors, the requests per second and the latency percentiles in ms.
+    """
+    parsed = urllib.parse.urlsplit(url)
+    rng = np.random.default_rng(seed)
+    queries = list(_requests(endpoint, requests, _weight_sets(weight_sets, rng), batch_size, rng))
+    latencies = []
+    errors = []
+    clients = [threading.Thread(target=_run_client, args=(parsed.hostname, parsed.port or 80, queries[i::concurrency], latencies, errors))
+               for i in range(concurrency)]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+    p50, p90, p99 = np.percentile(np.array(latencies) * 1000, [50, 90, 99])
+    return {'endpoint': endpoint, 'requests': len(latencies), 'errors': len(errors), 'requests_per_second': len(latencies) / elapsed,
+            'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99, 'max_ms': max(latencies) * 1000}
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Load generator for the tonality distance service (python -m src.service_load_test).')
+    parser.add_argument('--url', default='http://127.0.0.1:8052', help='base URL of the service')
+    parser.add_argument('--endpoint', nargs='+', default=['distance', 'path', 'tensor', 'distances'],
+                        choices=['distance', 'path', 'tensor', 'distances'], help='endpoints to load, one after the other')
+    parser.add_argument('--requests', type=int, default=1000, help='number of requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of client threads')
+    parser.add_argument('--weight-sets', type=int, default=16, help='number of distinct weight settings queried, fewer means more cache hits')
+    parser.add_argument('--batch-size', type=int, default=1000, help='number of key pairs per /api/distances request')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    print(f'{"endpoint":<10} {"requests":>8} {"errors":>6} {"req/s":>8} {"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8} {"max ms":>8}')
+    for endpoint in args.endpoint:
+        result = run_load_test(args.url, endpoint, args.requests, args.concurrency, args.weight_sets, args.batch_size, args.seed)
+        print(f'{endpoint:<10} {result["requests"]:>8} {result["errors"]:>6} {result["requests_per_second"]:>8.1f} '
+              f'{result["p50_ms"]:>8.2f} {result["p90_ms"]:>8.2f} {result["p99_ms"]:>8.2f} {result["max_ms"]:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
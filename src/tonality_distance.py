@@ -1,28 +1,386 @@
-import networkx as nx
 import numpy as np
 
 
-def get_tonality_distance(neighbor_weight = 1,
-                          relative_weight = 0.7,
-                          parallel_weight = 1.3,
-                          enharmonic_weight = 0.5,
-                          dominant_weight = 1.2): 
+# Every directed edge of the tonality graph, as a move relative to its source key:
+# (source mode, target mode, diatonic step, chromatic step, weight index, modulation)
+# The weight index follows the argument order of get_tonality_distance.
+MODULATIONS = [
+    ('M', 'M', 4, 7, 0, 'Neighbor (sharp)'),
+    ('M', 'M', -4, -7, 0, 'Neighbor (flat)'),
+    ('m', 'm', 4, 7, 0, 'Neighbor (sharp)'),
+    ('m', 'm', -4, -7, 0, 'Neighbor (flat)'),
+    ('m', 'M', 2, 3, 1, 'Relative major'),
+    ('M', 'm', -2, -3, 1, 'Relative minor'),
+    ('M', 'm', 0, 0, 2, 'Parallel'),
+    ('m', 'M', 0, 0, 2, 'Parallel'),
+    ('M', 'M', 1, 0, 3, 'Enharmonic'),
+    ('M', 'M', -1, 0, 3, 'Enharmonic'),
+    ('m', 'm', 1, 0, 3, 'Enharmonic'),
+    ('m', 'm', -1, 0, 3, 'Enharmonic'),
+    ('m', 'M', 4, 7, 4, 'Dominant minor (to V)'),
+    ('M', 'm', -4, -7, 4, 'Dominant minor (to i)'),
+]
+
+MODES = ['M', 'm']
+
+# Default modulation weights, in the argument order of get_tonality_distance
+DEFAULT_WEIGHTS = (1, 0.7, 1.3, 0.5, 1.2)
+
+MODULATION_WEIGHT_INDEX = {modulation: weight_index for _, _, _, _, weight_index, modulation in MODULATIONS}
+
+_modulation_weight = np.array([weight_index for _, _, _, _, weight_index, _ in MODULATIONS])
+
+
+def key_index(dia, chro, mode):
     """
-    Returns a 7x12x4 array of tonality distances and also returns the tonality graph. 
+    Returns the index of the key (dia, chro, mode) in the flat 168 key layout used by the numpy engine.
+    The layout is the one of a 7x12x2 array, mode 0 being major and 1 minor.
+    """
+    return (dia % 7 * 12 + chro % 12) * 2 + MODES.index(mode)
 
-    Tonality distance:
-    The first two dimensions represent the diatonic and chromatic space of the desired interval.
-    The last dimension represents the mode transition: 
-    0 for major -> major
-    1 for major -> minor
-    2 for minor -> major
-    3 for minor -> minor
 
-    Tonality graph:
-    The tonality graph is a directed graph with 7x12x2 nodes that represent the diatonic, chromatic space and the mode of the key
-    
+def index_key(index):
     """
-    
+    Returns the key (dia, chro, mode) at index in the flat 168 key layout, the inverse of key_index.
+    """
+    position, mode = divmod(int(index), 2)
+    dia, chro = divmod(position, 12)
+    return dia, chro, MODES[mode]
+
+
+def _build_in_edges():
+    """
+    Every key has exactly 7 incoming edges. Returns three 168x7 arrays giving, for each key and
+    incoming edge, the source key index, the weight index and the index of the edge in MODULATIONS.
+    Incoming edges are ordered by the (dia, chro) position of their source, then by their order in MODULATIONS.
+    """
+    source_mode, target_mode, dia_step, chro_step, weight_index = (np.array(column) for column in list(zip(*MODULATIONS))[:5])
+    source_mode, target_mode = (np.equal(mode, 'm').astype(int) for mode in (source_mode, target_mode))
+    dia, chro, modulation_index = np.meshgrid(np.arange(7), np.arange(12), np.arange(len(MODULATIONS)), indexing='ij')
+    source = (dia * 12 + chro) * 2 + source_mode[modulation_index]
+    target = ((dia + dia_step[modulation_index]) % 7 * 12 + (chro + chro_step[modulation_index]) % 12) * 2 + target_mode[modulation_index]
+    # The stable sort keeps the edges of every target in (source position, modulation) order
+    order = np.argsort(target.ravel(), kind='stable')
+    modulation_index = modulation_index.ravel()[order].reshape(168, 7)
+    return source.ravel()[order].reshape(168, 7), weight_index[modulation_index], modulation_index
+
+
+_in_source, _in_weight, _in_modulation = _build_in_edges()
+# Distances from C and c are relaxed together as one flat array of 2x168 entries (source mode first).
+# _relax_source[i, j] is the entry feeding the i-th incoming edge of entry j.
+_relax_source = np.concatenate([_in_source.T, _in_source.T + 168], axis=1)
+_relax_weight = np.concatenate([_in_weight.T, _in_weight.T], axis=1)
+_sources = np.array([key_index(0, 0, 'M'), 168 + key_index(0, 0, 'm')])
+
+
+def _edge_weight(weights):
+    """
+    Returns the weight of every incoming edge in the flat layout of _relax_source.
+    Relaxation only terminates without negative weights, which networkx rejects the same way.
+    """
+    weights = np.asarray(weights, dtype=float)
+    if np.isnan(weights).any():
+        raise ValueError('Modulation weights cannot be NaN')
+    if (weights < 0).any():
+        raise ValueError('Contradictory paths found: negative weights?')
+    return weights[_relax_weight]
+
+
+def _relax_distance(weights):
+    """
+    Returns the flat 2x168 distances from C and c, computed with min-plus relaxation over the in-edge arrays.
+    The graph is invariant under transposition, so only the distances from C and c are relaxed.
+    """
+    edge_weight = _edge_weight(weights)
+    distance = np.full(336, np.inf)
+    distance[_sources] = 0
+    return _relax(distance, edge_weight), edge_weight
+
+
+def _relax(distance, edge_weight):
+    """
+    Relaxes the flat 2x168 distances until they are stable. Starting from upper bounds given by the lengths
+    of actual paths, this takes as many passes as the bounds are far from the distances.
+    From scratch, that is one pass per modulation on the longest shortest path plus one: 8 passes with the
+    default weights, 43 with neighbor modulations only (the circle of fifths over 84 keys).
+    Shortest paths visit at most 336 entries, so more passes than that mean a negative cycle.
+
+    The passes are not folded into fewer, wider steps: composing two partial distances through the
+    transposition symmetry sums the weights in another order than networkx, which breaks exact equality
+    of the tensors, and two-hop steps relax 8 times more candidates per pass for half the passes.
+    """
+    for _ in range(336):
+        candidates = distance.take(_relax_source)
+        candidates += edge_weight
+        relaxed = candidates.min(axis=0)
+        np.minimum(relaxed, distance, out=relaxed)
+        if np.array_equal(relaxed, distance):
+            return distance
+        distance = relaxed
+    raise ValueError('Contradictory paths found: negative weights?')
+
+
+def _to_tensor(distance):
+    return distance.reshape(2, 7, 12, 2).transpose(1, 2, 0, 3).reshape(7, 12, 4)
+
+
+def _from_tensor(tonality_distance):
+    return tonality_distance.reshape(7, 12, 2, 2).transpose(2, 0, 1, 3).flatten()
+
+
+def _numpy_tonality_distance(weights):
+    """
+    Same tensor as the networkx engine, computed by the numpy engine.
+    """
+    return _to_tensor(_relax_distance(weights)[0])
+
+
+class ShortestPathTree:
+    """
+    Shortest paths from C and c for one weight setting.
+    Any other start key is served by transposing these two trees, so every path is rebuilt in O(path length).
+
+    tonality_distance is the 7x12x4 tensor of get_tonality_distance and weights the weights it was computed with.
+    predecessor[source mode, key index] is the previous key index on the path from C (source mode 0) or c (1),
+    -1 for the sources themselves, and modulation gives the index in MODULATIONS of the edge reaching the key.
+    dag[source mode, key index, i] tells whether the i-th incoming edge of the key (see _in_source) lies on a
+    shortest path, and order lists the key indices in a topological order of that shortest-path DAG.
+    hops[source mode, key index] is the number of modulations on the path to the key.
+    """
+    def __init__(self, tonality_distance, predecessor, modulation, weights = None, dag = None, order = None, hops = None):
+        self.tonality_distance = tonality_distance
+        self.predecessor = predecessor
+        self.modulation = modulation
+        self.weights = weights
+        self.dag = dag
+        self.order = order
+        self.hops = hops
+        self._path_counts = [None, None]
+
+    def _walk(self, start, end):
+        start_dia, start_chro, start_mode = start
+        end_dia, end_chro, end_mode = end
+        source_mode = MODES.index(start_mode)
+        index = key_index(end_dia - start_dia, end_chro - start_chro, end_mode)
+        indices = []
+        while index != -1:
+            indices.append(index)
+            index = self.predecessor[source_mode, index]
+        indices.reverse()
+        return source_mode, indices
+
+    @staticmethod
+    def _transpose(start, indices):
+        start_dia, start_chro, _ = start
+        path = []
+        for index in indices:
+            dia, chro, mode = index_key(index)
+            path.append(((dia + start_dia) % 7, (chro + start_chro) % 12, mode))
+        return path
+
+    def path(self, start, end):
+        """
+        Returns a shortest path from start to end as a list of (dia, chro, mode) keys, like nx.shortest_path.
+        """
+        _, indices = self._walk(start, end)
+        return self._transpose(start, indices)
+
+    def path_modulations(self, start, end):
+        """
+        Returns the modulation label of every edge on the path returned by path(start, end).
+        """
+        source_mode, indices = self._walk(start, end)
+        return [MODULATIONS[self.modulation[source_mode, index]][5] for index in indices[1:]]
+
+    def _counts(self, source_mode):
+        """
+        Returns the number of shortest paths from the source to every key, counted over the shortest-path
+        DAG in topological order. Counts are Python integers, so they never overflow.
+        """
+        counts = self._path_counts[source_mode]
+        if counts is None:
+            counts = [0] * 168
+            for index in self.order[source_mode].tolist():
+                in_edges = np.flatnonzero(self.dag[source_mode, index])
+                if index == _sources[source_mode] % 168:
+                    counts[index] = 1
+                else:
+                    counts[index] = sum(counts[source] for source in _in_source[index, in_edges].tolist())
+            self._path_counts[source_mode] = counts
+        return counts
+
+    def count_paths(self, start, end):
+        """
+        Returns the number of shortest paths from start to end without enumerating them.
+        """
+        end_dia, end_chro, end_mode = end
+        return self._counts(MODES.index(start[2]))[key_index(end_dia - start[0], end_chro - start[1], end_mode)]
+
+    def _kth(self, start, end, k):
+        end_dia, end_chro, end_mode = end
+        source_mode = MODES.index(start[2])
+        counts = self._counts(source_mode)
+        index = key_index(end_dia - start[0], end_chro - start[1], end_mode)
+        if not 0 <= k < counts[index]:
+            raise IndexError(f'There are {counts[index]} shortest paths from {start} to {end}, not {k + 1}')
+        indices = [index]
+        modulations = []
+        while index != _sources[source_mode] % 168:
+            for in_edge in np.flatnonzero(self.dag[source_mode, index]).tolist():
+                source = _in_source[index, in_edge]
+                if k < counts[source]:
+                    break
+                k -= counts[source]
+            modulations.append(MODULATIONS[_in_modulation[index, in_edge]][5])
+            index = source
+            indices.append(index)
+        indices.reverse()
+        modulations.reverse()
+        return indices, modulations
+
+    def kth_path(self, start, end, k):
+        """
+        Returns the k-th (from 0) shortest path from start to end in O(path length), without enumerating
+        the previous ones. Paths are ordered by the in-edge order of the keys, walking back from end.
+        """
+        return self.kth_path_with_modulations(start, end, k)[0]
+
+    def kth_path_modulations(self, start, end, k):
+        """
+        Returns the modulation label of every edge on the path returned by kth_path(start, end, k).
+        """
+        return self.kth_path_with_modulations(start, end, k)[1]
+
+    def kth_path_with_modulations(self, start, end, k):
+        """
+        Returns (kth_path(start, end, k), kth_path_modulations(start, end, k)) from a single walk of the path.
+        """
+        indices, modulations = self._kth(start, end, k)
+        return self._transpose(start, indices), modulations
+
+    def paths(self, start, end, offset = 0, limit = None):
+        """
+        Yields the shortest paths from start to end from the offset-th one, at most limit of them.
+        """
+        count = self.count_paths(start, end)
+        stop = count if limit is None else min(count, offset + limit)
+        for k in range(offset, stop):
+            yield self.kth_path(start, end, k)
+
+
+def get_shortest_path_tree(neighbor_weight = 1,
+                           relative_weight = 0.7,
+                           parallel_weight = 1.3,
+                           enharmonic_weight = 0.5,
+                           dominant_weight = 1.2):
+    """
+    Returns the ShortestPathTree of the tonality graph for these weights, computed by the numpy engine.
+
+    Among the edges that reach a key at its shortest distance, the predecessor is taken on the path with
+    the fewest modulations, which keeps the tree acyclic even for keys only reachable through disabled
+    (np.inf) modulation types. For these keys the shortest-path DAG is likewise restricted to the paths
+    with the fewest modulations. Weights are expected to be positive.
+    """
+    weights = (neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight)
+    distance, edge_weight = _relax_distance(weights)
+    hops = np.full(336, np.inf)
+    hops[_sources] = 0
+    return _shortest_path_tree(distance, edge_weight, weights, hops)
+
+
+def _tight_hops(tight, hops):
+    """
+    Returns the fewest modulations on the paths of tight edges from the sources, relaxed from the estimate hops.
+    Every key is reached by such a path, so the relaxation has a single fixed point whatever the estimate,
+    and stops after as many passes as the estimate is far from it.
+    """
+    hop_weight = np.where(tight, 1, np.inf)
+    while True:
+        candidates = hops.take(_relax_source)
+        candidates += hop_weight
+        relaxed = candidates.min(axis=0)
+        relaxed[_sources] = 0
+        if np.array_equal(relaxed, hops):
+            return hops
+        hops = relaxed
+
+
+def _shortest_path_tree(distance, edge_weight, weights, hops):
+    """
+    Builds the ShortestPathTree from the flat 2x168 distances, hops being an estimate for _tight_hops.
+    """
+    tight = distance.take(_relax_source) + edge_weight == distance
+    hops = _tight_hops(tight, hops)
+
+    fewest_hops = tight & (hops.take(_relax_source) + 1 == hops)
+    in_edge = fewest_hops.argmax(axis=0)
+    columns = np.arange(336)
+    predecessor = _relax_source[in_edge, columns] % 168
+    predecessor[_sources] = -1
+    modulation = np.concatenate([_in_modulation, _in_modulation])[columns, in_edge]
+
+    dag = np.where(np.isfinite(distance), tight, fewest_hops)
+    dag[:, _sources] = False
+    order = np.stack([np.lexsort((hops[block], distance[block])) for block in (slice(0, 168), slice(168, 336))])
+    return ShortestPathTree(_to_tensor(distance), predecessor.reshape(2, 168), modulation.reshape(2, 168),
+                            weights, dag.T.reshape(2, 168, 7), order, hops.reshape(2, 168))
+
+
+def update_shortest_path_tree(tree,
+                              neighbor_weight = 1,
+                              relative_weight = 0.7,
+                              parallel_weight = 1.3,
+                              enharmonic_weight = 0.5,
+                              dominant_weight = 1.2):
+    """
+    Returns the ShortestPathTree for these weights, updated from tree, the ShortestPathTree of weights that
+    differ in a single modulation type (a slider drag or a checklist toggle).
+
+    Only the edges of that modulation type change weight, so the previous distances are relaxed again
+    as upper bounds instead of starting from infinity:
+    - when the weight decreases, every path got shorter and all the previous distances are kept
+    - when it increases, a key keeps its distance if its path in tree uses no edge of that modulation
+      type, the other keys start again from infinity
+    The previous hops are likewise the starting estimate of the fewest modulations on the shortest paths.
+    The result is identical to get_shortest_path_tree, which it falls back to when several weights changed
+    or when tree does not hold its weights and hops. tree itself is returned if the weights did not change.
+    """
+    weights = (neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight)
+    edge_weight = _edge_weight(weights)
+    if tree.weights is None or tree.hops is None:
+        return get_shortest_path_tree(*weights)
+    changed = [i for i, (old, new) in enumerate(zip(tree.weights, weights)) if old != new]
+    if not changed:
+        return tree
+    if len(changed) > 1:
+        return get_shortest_path_tree(*weights)
+
+    weight_index = changed[0]
+    distance = _from_tensor(tree.tonality_distance)
+    if weights[weight_index] > tree.weights[weight_index]:
+        # Pointer jumping along the predecessors flags the keys whose path uses the modulation type
+        parent = (tree.predecessor + [[0], [168]]).ravel()
+        parent[_sources] = _sources
+        changed_path = _modulation_weight[tree.modulation.ravel()] == weight_index
+        changed_path[_sources] = False
+        while True:
+            changed_path |= changed_path[parent]
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+        distance[changed_path] = np.inf
+    distance = _relax(distance, edge_weight)
+    return _shortest_path_tree(distance, edge_weight, weights, tree.hops.ravel())
+
+
+def _build_keys_graph(neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight):
+    """
+    Returns the tonality graph of get_tonality_distance.
+    """
+    # networkx takes longer to import than the rest of the package, only this engine needs it
+    import networkx as nx
+
     keys_graph = nx.DiGraph()
     for dia in range(7):
         for chro in range(12):
@@ -54,6 +412,14 @@ def get_tonality_distance(neighbor_weight = 1,
                     dominant = ((dia+4)%7,(chro+7)%12,'M')
                     keys_graph.add_edge(key,dominant,weight=dominant_weight, modulation = 'Dominant minor (to V)')
                     keys_graph.add_edge(dominant,key,weight=dominant_weight, modulation = 'Dominant minor (to i)')
+    return keys_graph
+
+
+def _dijkstra_tonality_distance(keys_graph):
+    """
+    Returns the 7x12x4 tonality distance tensor from Dijkstra runs from C and c in the tonality graph.
+    """
+    import networkx as nx
 
     shortest_path_length_major = nx.shortest_path_length(keys_graph,(0,0,'M'),weight='weight')
     tonality_distance = np.zeros((7,12,4)) 
@@ -63,4 +429,39 @@ def get_tonality_distance(neighbor_weight = 1,
     shortest_path_length_minor = nx.shortest_path_length(keys_graph,(0,0,'m'),weight='weight')
     for (dia, chro, mode), distance in shortest_path_length_minor.items():
         tonality_distance[dia,chro,2+int(mode == 'm')] = distance
-    return tonality_distance, keys_graph
\ No newline at end of file
+    return tonality_distance
+
+
+def get_tonality_distance(neighbor_weight = 1,
+                          relative_weight = 0.7,
+                          parallel_weight = 1.3,
+                          enharmonic_weight = 0.5,
+                          dominant_weight = 1.2,
+                          engine = 'networkx'): 
+    """
+    Returns a 7x12x4 array of tonality distances and also returns the tonality graph. 
+
+    engine selects how the distances are computed:
+    'networkx' builds the tonality graph and runs Dijkstra from C and c (reference implementation)
+    'numpy' relaxes dense in-edge arrays and does not build the graph (None is returned in its place)
+
+    Tonality distance:
+    The first two dimensions represent the diatonic and chromatic space of the desired interval.
+    The last dimension represents the mode transition: 
+    0 for major -> major
+    1 for major -> minor
+    2 for minor -> major
+    3 for minor -> minor
+
+    Tonality graph:
+    The tonality graph is a directed graph with 7x12x2 nodes that represent the diatonic, chromatic space and the mode of the key
+    
+    """
+    if engine == 'numpy':
+        weights = (neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight)
+        return _numpy_tonality_distance(weights), None
+    if engine != 'networkx':
+        raise ValueError(f'Unknown engine: {engine}')
+
+    keys_graph = _build_keys_graph(neighbor_weight, relative_weight, parallel_weight, enharmonic_weight, dominant_weight)
+    return _dijkstra_tonality_distance(keys_graph), keys_graph
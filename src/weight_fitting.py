@@ -0,0 +1,128 @@
+import contextlib
+
+import numpy as np
+
+from src.batch_distance import tensor_entries
+from src.path_signatures import PathSignatureEngine
+from src.tonality_distance import DEFAULT_WEIGHTS, get_tonality_distance
+
+
+class SquaredErrorLoss:
+    """
+    Mean squared error between the tonality distances of candidate weights and target distances.
+
+    Pairs are reduced to per tensor entry statistics (count, sum and sum of squares of the targets), so
+    evaluating a candidate costs the same for a thousand or a million labelled pairs, and only the
+    signatures of the tensor entries present in the data are evaluated.
+    """
+    def __init__(self, keys_from, keys_to, targets, engine = None):
+        entries = tensor_entries(keys_from, keys_to).ravel()
+        targets = np.asarray(targets, dtype=float).ravel()
+        self.entries, inverse = np.unique(entries, return_inverse=True)
+        self.counts = np.bincount(inverse, minlength=len(self.entries))
+        self.sums = np.bincount(inverse, weights=targets, minlength=len(self.entries))
+        self.squares = np.bincount(inverse, weights=targets ** 2, minlength=len(self.entries))
+        self.n_pairs = len(targets)
+        self.engine = (engine or PathSignatureEngine()).subset(self.entries)
+
+    def __call__(self, weights):
+        """
+        Returns the loss of every row of a Bx5 array of candidate weights.
+        """
+        distances = self.engine.entry_distances(weights)
+        with np.errstate(invalid='ignore'):
+            total = (self.counts * distances ** 2 - 2 * self.sums * distances + self.squares).sum(axis=1)
+        return np.where(np.isnan(total), np.inf, total) / self.n_pairs
+
+
+class WeightFit:
+    """
+    Result of fit_weights: the fitted weights, their loss, the best loss after every iteration,
+    and the residual (distance - target) of every labelled pair for the fitted weights.
+    """
+    def __init__(self, weights, loss, loss_curve, residuals):
+        self.weights = weights
+        self.loss = loss
+        self.loss_curve = loss_curve
+        self.residuals = residuals
+
+    def __repr__(self):
+        return f'WeightFit(weights={self.weights}, loss={self.loss}, iterations={len(self.loss_curve)})'
+
+
+_worker_loss = None
+
+
+def _init_worker(loss):
+    global _worker_loss
+    _worker_loss = loss
+
+
+def _loss_in_worker(weights):
+    return _worker_loss(weights)
+
+
+def fit_weights(keys_from, keys_to, targets,
+                initial_weights = DEFAULT_WEIGHTS,
+                bounds = (0.01, 10),
+                population = 4096,
+                elite_fraction = 0.05,
+                max_iterations = 100,
+                patience = 10,
+                tolerance = 1e-9,
+                processes = 1,
+                seed = 0):
+    """
+    Fits the five modulation weights to target distances between pairs of keys with the cross-entropy method.
+
+    keys_from and keys_to are given in any form accepted by batch_distance.encode_keys.
+    Every iteration draws a population of candidate weight vectors from a log-normal distribution,
+    evaluates them all at once (split across processes worker processes when processes > 1) and refits the
+    distribution on the elite candidates. The search stops early when the best loss has not improved by more
+    than tolerance for patience iterations.
+    """
+    loss = SquaredErrorLoss(keys_from, keys_to, targets)
+    rng = np.random.default_rng(seed)
+    low, high = np.log(bounds[0]), np.log(bounds[1])
+    mean = np.clip(np.log(np.asarray(initial_weights, dtype=float)), low, high)
+    std = np.full(5, (high - low) / 4)
+    n_elite = max(2, int(population * elite_fraction))
+
+    best_weights = np.exp(mean)
+    best_loss = loss(best_weights)[0]
+    loss_curve = []
+    stalled = 0
+    if processes > 1:
+        # Fits in a single process, and importers of SquaredErrorLoss, do not import multiprocessing
+        from multiprocessing import Pool
+
+        workers = Pool(processes, initializer=_init_worker, initargs=(loss,))
+    else:
+        workers = contextlib.nullcontext()
+    # The pool is terminated on leaving the block, also when the fit raises
+    with workers as pool:
+        for _ in range(max_iterations):
+            candidates = np.exp(np.clip(rng.normal(mean, std, (population, 5)), low, high))
+            if pool is None:
+                losses = loss(candidates)
+            else:
+                losses = np.concatenate(pool.map(_loss_in_worker, np.array_split(candidates, processes)))
+            elite = np.argsort(losses)[:n_elite]
+            mean = np.log(candidates[elite]).mean(axis=0)
+            std = np.log(candidates[elite]).std(axis=0) + 1e-6
+
+            if losses[elite[0]] < best_loss - tolerance:
+                best_loss = losses[elite[0]]
+                best_weights = candidates[elite[0]]
+                stalled = 0
+            else:
+                stalled += 1
+            loss_curve.append(best_loss)
+            if stalled >= patience:
+                break
+
+    weights = tuple(float(weight) for weight in best_weights)
+    tonality_distance, _ = get_tonality_distance(*weights, engine='numpy')
+    entries = tensor_entries(keys_from, keys_to)
+    residuals = tonality_distance.ravel()[entries] - np.asarray(targets, dtype=float)
+    return WeightFit(weights, float(best_loss), np.array(loss_curve), residuals)